@@ -0,0 +1,104 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Microbenchmark: MappedClassBase.asDict() compared to the Proxy
+implementation of z3c.sqlalchemy 3.0 and earlier.
+
+Usage: python benchmarks/bench_asdict.py [rows] [columns]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+
+from z3c.sqlalchemy import createSAWrapper
+from z3c.sqlalchemy.mapper import Proxy
+
+
+class LegacyProxy(dict):
+    """ Proxy implementation of z3c.sqlalchemy 3.0 """
+
+    def __init__(self, obj):
+        super(dict, self).__init__()
+        self.update(obj.__dict__.copy())
+        for attr in getattr(obj, 'proxied_properties', ()):
+            self[attr] = getattr(obj, attr)
+        del self['_sa_instance_state']
+
+    def __getattribute__(self, name):
+        if name in dict.keys(self):
+            return self.get(name)
+
+        return super(dict, self).__getattribute__(name)
+
+    def __getattr__(self, name, default=None):
+        if name in dict.keys(self):
+            return self.get(name, default)
+        return super(dict, self).__getattr__(name, default)
+
+
+def setup(filename, rows, columns):
+    wrapper = createSAWrapper('sqlite:///%s' % filename)
+    metadata = MetaData()
+    table = Table('wide', metadata,
+                  Column('id', Integer, primary_key=True),
+                  *[Column('col%d' % i, String(50)) for i in range(columns)])
+    metadata.create_all(wrapper.engine)
+    with wrapper.engine.begin() as connection:
+        connection.execute(
+            table.insert(),
+            [dict([('id', n)] + [('col%d' % i, 'value %d' % i)
+                                 for i in range(columns)])
+             for n in range(rows)])
+    Wide = wrapper.getMapper('wide')
+    return wrapper.session.query(Wide).all()
+
+
+def measure(factory, objects, repeat=5):
+    """ best time for converting all objects and reading three
+        attributes of each converted dict
+    """
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for obj in objects:
+            d = factory(obj)
+            d.id, d.col0, d.col1
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main(rows=10000, columns=20):
+    filename = tempfile.mktemp(suffix='.db')
+    try:
+        objects = setup(filename, rows, columns)
+        legacy = measure(LegacyProxy, objects)
+        current = measure(Proxy, objects)
+    finally:
+        os.remove(filename)
+
+    print('rows=%d columns=%d' % (rows, columns))
+    print('legacy Proxy: %8.1f ms  %10.0f rows/s' % (legacy * 1000,
+                                                     rows / legacy))
+    print('Proxy:        %8.1f ms  %10.0f rows/s' % (current * 1000,
+                                                     rows / current))
+    print('speedup:      %8.2fx' % (legacy / current))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,345 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Benchmark suite for the hot paths of the wrapper. All benchmarks run
+against a temporary SQLite file. The results are written as JSON in order
+to compare them between releases.
+
+Usage: python benchmarks/run.py [--quick] [--output results.json]
+                                [--compare baseline.json] [benchmark ...]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import sqlalchemy
+import transaction
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+
+from z3c.sqlalchemy import Model
+from z3c.sqlalchemy import createSAWrapper
+
+
+def best(func, repeat):
+    """ best wall clock time of 'repeat' calls of func() """
+
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if result is None or duration < result:
+            result = duration
+    return result
+
+
+def createTables(dsn, count, columns=5):
+    """ create the tables t0 ... t<count - 1> """
+
+    metadata = MetaData()
+    for i in range(count):
+        Table('t%d' % i, metadata,
+              Column('id', Integer, primary_key=True),
+              *[Column('col%d' % c, String(50)) for c in range(columns)])
+    engine = sqlalchemy.create_engine(dsn)
+    metadata.create_all(engine)
+    engine.dispose()
+
+
+def createRows(dsn, rows, columns=20):
+    """ create the table 'wide' holding 'rows' rows """
+
+    metadata = MetaData()
+    table = Table('wide', metadata,
+                  Column('id', Integer, primary_key=True),
+                  *[Column('col%d' % c, String(50)) for c in range(columns)])
+    engine = sqlalchemy.create_engine(dsn)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(table.insert(), [makeRow(n, columns)
+                                            for n in range(rows)])
+    engine.dispose()
+
+
+def makeRow(n, columns=20):
+    return dict([('id', n)] + [('col%d' % c, 'value %d' % c)
+                               for c in range(columns)])
+
+
+def benchConstruction(dsn, options):
+    """ createSAWrapper() without and with a model """
+
+    model = Model()
+    for i in range(100):
+        model.add('t%d' % i)
+    repeat = options.repeat * 10
+    plain = best(lambda: createSAWrapper(dsn).engine.dispose(), repeat)
+    with_model = best(
+        lambda: createSAWrapper(dsn, model=model).engine.dispose(), repeat)
+    return {'plain': plain, 'model_100_tables': with_model}
+
+
+def benchGetMapper(dsn, options):
+    """ cold (reflecting) and warm (cached) getMapper() calls """
+
+    result = {}
+    for count in options.tables:
+        names = ['t%d' % i for i in range(count)]
+
+        def cold():
+            wrapper = createSAWrapper(dsn)
+            for name in names:
+                wrapper.getMapper(name)
+            wrapper.engine.dispose()
+
+        wrapper = createSAWrapper(dsn)
+        for name in names:
+            wrapper.getMapper(name)
+
+        def warm():
+            for i in range(10):
+                for name in names:
+                    wrapper.getMapper(name)
+
+        cold_time = best(cold, options.repeat)
+        warm_time = best(warm, options.repeat) / (10 * count)
+        result['tables_%d' % count] = {'cold': cold_time,
+                                       'cold_per_table': cold_time / count,
+                                       'warm_per_call': warm_time}
+    return result
+
+
+def benchGetMappers(dsn, options):
+    """ getMappers() reflecting all tables in one pass """
+
+    result = {}
+    for count in options.tables:
+        names = ['t%d' % i for i in range(count)]
+
+        def cold():
+            wrapper = createSAWrapper(dsn)
+            wrapper.getMappers(*names)
+            wrapper.engine.dispose()
+
+        duration = best(cold, options.repeat)
+        result['tables_%d' % count] = {'cold': duration,
+                                       'cold_per_table': duration / count}
+    return result
+
+
+def benchSession(dsn, options):
+    """ wrapper.session acquisition and a trivial statement per (Zope)
+        transaction under N threads
+    """
+
+    wrapper = createSAWrapper(dsn, engine_options={'pool_size': 32})
+    iterations = options.iterations
+    result = {}
+    for count in options.threads:
+
+        def work():
+            for i in range(iterations):
+                wrapper.session.execute(sqlalchemy.text('SELECT 1'))
+                transaction.commit()
+
+        def run():
+            threads = [threading.Thread(target=work) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        duration = best(run, options.repeat)
+        result['threads_%d' % count] = {
+            'seconds': duration,
+            'transactions_per_second': count * iterations / duration}
+    wrapper.engine.dispose()
+    return result
+
+
+def benchAsDict(dsn, options):
+    """ asDict() and clone() throughput """
+
+    wrapper = createSAWrapper(dsn)
+    Wide = wrapper.getMapper('wide')
+    objects = wrapper.session.query(Wide).all()
+    rows = len(objects)
+
+    def as_dict():
+        for obj in objects:
+            obj.asDict()
+
+    def clone():
+        for obj in objects:
+            obj.clone()
+
+    as_dict_time = best(as_dict, options.repeat)
+    clone_time = best(clone, options.repeat)
+    transaction.abort()
+    wrapper.engine.dispose()
+    return {'asdict_rows_per_second': rows / as_dict_time,
+            'clone_rows_per_second': rows / clone_time}
+
+
+def benchBulkInsert(dsn, options):
+    """ bulkInsert() of options.rows rows """
+
+    rows = [makeRow(n) for n in range(options.rows)]
+    wrapper = createSAWrapper(dsn)
+    wrapper.getMapper('wide')
+
+    def insert():
+        wrapper.session.execute(sqlalchemy.text('DELETE FROM wide'))
+        wrapper.bulkInsert('wide', rows)
+        transaction.commit()
+
+    duration = best(insert, options.repeat)
+    wrapper.engine.dispose()
+    return {'seconds': duration, 'rows_per_second': len(rows) / duration}
+
+
+def benchStream(dsn, options):
+    """ stream() over all rows, as objects and as dicts """
+
+    wrapper = createSAWrapper(dsn)
+    Wide = wrapper.getMapper('wide')
+    result = {}
+    for as_dict in (False, True):
+
+        def stream():
+            count = 0
+            for obj in wrapper.stream(Wide, as_dict=as_dict):
+                count += 1
+            transaction.abort()
+
+        duration = best(stream, options.repeat)
+        key = as_dict and 'dicts_per_second' or 'objects_per_second'
+        result[key] = options.rows / duration
+    wrapper.engine.dispose()
+    return result
+
+
+# name -> (benchmark, setup of the database)
+BENCHMARKS = {
+    'construction': (benchConstruction, 'tables'),
+    'getMapper': (benchGetMapper, 'tables'),
+    'getMappers': (benchGetMappers, 'tables'),
+    'session': (benchSession, None),
+    'asDict': (benchAsDict, 'rows'),
+    'bulkInsert': (benchBulkInsert, 'rows'),
+    'stream': (benchStream, 'rows'),
+}
+
+
+def environment():
+    try:
+        from importlib.metadata import version
+        z3c_version = version('z3c.sqlalchemy')
+    except Exception:
+        z3c_version = None
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'z3c.sqlalchemy': z3c_version,
+            'sqlite': sqlite3.sqlite_version}
+
+
+def flatten(results, prefix=''):
+    """ return a dict 'benchmark.key...' -> number """
+
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, '%s%s.' % (prefix, key)))
+        else:
+            flat['%s%s' % (prefix, key)] = value
+    return flat
+
+
+def compare(baseline, results):
+    """ print the relative change of all results compared to a baseline """
+
+    old = flatten(baseline['results'])
+    new = flatten(results['results'])
+    for key in sorted(new):
+        if key not in old or not old[key]:
+            continue
+        change = (new[key] - old[key]) / old[key] * 100
+        # for throughputs (per_second) larger is better
+        better = (change > 0) == key.endswith('per_second')
+        print('%-55s %12.6g %12.6g %+8.1f%% %s' % (
+            key, old[key], new[key], change,
+            abs(change) >= 10 and (better and 'better' or 'WORSE') or ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run (default: all of %s)' %
+                        ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller data sets and fewer repetitions')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with the results of a '
+                        'previous run')
+    options = parser.parse_args(argv)
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+
+    if options.quick:
+        options.tables, options.threads = (10, 100), (1, 4)
+        options.rows, options.iterations, options.repeat = 2000, 100, 1
+    else:
+        options.tables, options.threads = (10, 100, 1000), (1, 4, 16)
+        options.rows, options.iterations, options.repeat = 20000, 500, 3
+
+    directory = tempfile.mkdtemp()
+    results = {'environment': environment(), 'results': {}}
+    try:
+        dsns = {}
+        dsns['tables'] = 'sqlite:///%s' % os.path.join(directory, 'tables.db')
+        createTables(dsns['tables'], max(options.tables))
+        dsns['rows'] = 'sqlite:///%s' % os.path.join(directory, 'rows.db')
+        createRows(dsns['rows'], options.rows)
+        dsns[None] = 'sqlite:///%s' % os.path.join(directory, 'empty.db')
+
+        for name in options.benchmarks or sorted(BENCHMARKS):
+            benchmark, db = BENCHMARKS[name]
+            sys.stderr.write('%s...\n' % name)
+            results['results'][name] = benchmark(dsns[db], options)
+    finally:
+        shutil.rmtree(directory)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(json.load(fp), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -69,4 +69,7 @@ setup(name='z3c.sqlalchemy',
           'zope.testing',
           'zope.schema',
       ],
-      extras_require=dict(test=['zope.testing']))
+      extras_require=dict(
+          asyncio=['SQLAlchemy[asyncio]>=1.4'],
+          test=['zope.testing', 'aiosqlite', 'SQLAlchemy[asyncio]>=1.4'],
+      ))
@@ -0,0 +1,214 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+asyncio support
+"""
+
+import asyncio
+import time
+from itertools import islice
+
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import async_scoped_session
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine
+from zope.interface import implementer_only
+
+from z3c.sqlalchemy.base import ZopeWrapper
+from z3c.sqlalchemy.interfaces import IAsyncSQLAlchemyWrapper
+from z3c.sqlalchemy.mapper import Proxy
+from z3c.sqlalchemy.stats import PoolStatistics
+from z3c.sqlalchemy.stats import poolSize
+
+
+@implementer_only(IAsyncSQLAlchemyWrapper)
+class AsyncZopeWrapper(ZopeWrapper):
+    """ A wrapper based on the asyncio extension of SQLAlchemy. Sessions
+        are scoped per asyncio task. The sessions do *not* participate in
+        Zope transactions (those are bound to threads), they must be
+        committed explicitly (await wrapper.session.commit()). Call
+        'await wrapper.remove()' at the end of a task in order to close
+        its session.
+
+        getMapper(), getMappers(), preload(), warmup(), bulkInsert() and
+        bulkUpsert() are coroutines, stream() is an asynchronous generator.
+        'connection', cached() and the reference data of ISQLAlchemyWrapper
+        are not available.
+    """
+
+    def __init__(self, dsn, model=None, **kw):
+        for name in ('reflection_cache', 'replicas', 'profile_transactions',
+                     'profile_hook', 'result_cache', 'idle_timeout'):
+            if kw.get(name):
+                raise ValueError("'%s' is not supported by AsyncZopeWrapper"
+                                 % name)
+        # the locks of LazyMapperCollection are thread locks, which do not
+        # separate the tasks of the event loop: reflecting and mapping is
+        # serialized by one lock for all tasks instead
+        self._mapper_lock = asyncio.Lock()
+        super().__init__(dsn, model, **kw)
+
+    @property
+    def connection(self):
+        raise NotImplementedError('Use "await wrapper.session.connection()"')
+
+    async def remove(self):
+        """ close the session of the current task """
+        await self._sessionmaker.remove()
+
+    async def getMapper(self, tablename, schema='public'):
+        try:
+            return self._mappers[tablename]
+        except KeyError:
+            pass
+
+        async with self._mapper_lock:
+            if tablename not in self._mappers:
+                async with self._engine.connect() as connection:
+                    await connection.run_sync(
+                        lambda conn: self._mappers.getMapper(
+                            tablename, schema, bind=conn))
+        return self._mappers[tablename]
+
+    async def getMappers(self, *names):
+        async with self._mapper_lock:
+            async with self._engine.connect() as connection:
+                return await connection.run_sync(
+                    lambda conn: self._mappers.getMappers(*names, bind=conn))
+
+    async def preload(self):
+        if self._model is not None:
+            return await self.getMappers(*self._model.names)
+        return ()
+
+    async def warmup(self, mappers=True, connections=0):
+        """ see ZopeWrapper.warmup() """
+
+        timings = {}
+        start = time.perf_counter()
+        if mappers:
+            await self.preload()
+            timings['mappers'] = time.perf_counter() - start
+            timings['configure'] = self.configure()
+
+        if connections:
+            step = time.perf_counter()
+            size = poolSize(self._engine.pool)
+            if size is not None:
+                connections = min(connections, size)
+            opened = await asyncio.gather(
+                *[self._engine.connect().start()
+                  for i in range(connections)], return_exceptions=True)
+            errors = [c for c in opened if isinstance(c, BaseException)]
+            for connection in opened:
+                if connection not in errors:
+                    await connection.close()
+            if errors:
+                raise errors[0]
+            timings['connections'] = time.perf_counter() - step
+
+        timings['total'] = time.perf_counter() - start
+        return timings
+
+    async def stream(self, mapper, criteria=None, batch_size=1000,
+                     as_dict=False):
+        """ Asynchronous generator, see ZopeWrapper.stream() """
+
+        if isinstance(mapper, str):
+            mapper = await self.getMapper(mapper)
+
+        statement = self._selectStatement(mapper, criteria)
+        session = self.session
+        result = await session.stream_scalars(
+            statement, execution_options={'yield_per': batch_size})
+        try:
+            async for partition in result.partitions():
+                for obj in partition:
+                    if as_dict:
+                        yield Proxy(obj)
+                    else:
+                        yield obj
+
+                for obj in partition:
+                    if obj in session:
+                        session.expunge(obj)
+        finally:
+            await result.close()
+
+    def getReferenceData(self, name):
+        raise NotImplementedError('getReferenceData() is not supported by '
+                                  'AsyncZopeWrapper')
+
+    def reloadReferenceData(self, name=None):
+        raise NotImplementedError('reloadReferenceData() is not supported '
+                                  'by AsyncZopeWrapper')
+
+    async def bulkInsert(self, name, rows, chunk_size=1000):
+        """ Coroutine, see ZopeWrapper.bulkInsert(). The session of the
+            current task must be committed explicitly.
+        """
+
+        table = await self._getTable(name)
+        statement = table.insert()
+        return await self._bulkExecute(name, lambda chunk: statement, rows,
+                                       chunk_size)
+
+    async def bulkUpsert(self, name, rows, chunk_size=1000,
+                         index_elements=None):
+        """ Coroutine, see ZopeWrapper.bulkUpsert(). The session of the
+            current task must be committed explicitly.
+        """
+
+        table = await self._getTable(name)
+        if index_elements is None:
+            index_elements = [col.name for col in table.primary_key]
+
+        def statement(chunk):
+            return self._upsertStatement(table, chunk[0].keys(),
+                                         index_elements)
+
+        return await self._bulkExecute(name, statement, rows, chunk_size)
+
+    async def _getTable(self, name):
+        return inspect(await self.getMapper(name)).local_table
+
+    async def _bulkExecute(self, name, statement, rows, chunk_size):
+        session = self.session
+        stats = []
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            for bind_arguments, part in self._partitionRows(name, chunk):
+                start = time.perf_counter()
+                await session.execute(statement(part), part,
+                                      bind_arguments=bind_arguments)
+                stats.append({'chunk': len(stats),
+                              'rows': len(part),
+                              'seconds': time.perf_counter() - start})
+        return stats
+
+    def _allEngines(self):
+        # pool events are only available for the synchronous engine
+        return [self._v_engine.sync_engine]
+
+    def _createEngine(self):
+        self._engine = create_async_engine(self.dsn, **self.engine_options)
+        self._pool_stats = PoolStatistics()
+        self._pool_stats.attach(self._engine.sync_engine)
+        if self._query_stats is not None:
+            self._query_stats.attach(self._engine.sync_engine)
+        if self._circuit is not None:
+            self._circuit.attach(self._engine.sync_engine)
+        self._replicas = None
+        self._sessionmaker = async_scoped_session(
+            async_sessionmaker(bind=self._engine,
+                               autoflush=True,
+                               **self.session_options),
+            scopefunc=asyncio.current_task)
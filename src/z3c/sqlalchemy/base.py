@@ -5,28 +5,90 @@
 # Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
 # and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
 ##########################################################################
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 from sqlalchemy import MetaData
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy import text
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm import registry
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 from zope.component import getUtility
 from zope.interface import implementer
 from zope.interface.interfaces import ComponentLookupError
+from zope.sqlalchemy import mark_changed
 from zope.sqlalchemy import register
 
+from z3c.sqlalchemy import fork
+from z3c.sqlalchemy.cache import DIRTY_KEY
+from z3c.sqlalchemy.cache import ResultCache
+from z3c.sqlalchemy.cache import sizeOf
+from z3c.sqlalchemy.cache import statementTables
+from z3c.sqlalchemy.circuit import CircuitBreaker
+from z3c.sqlalchemy.idle import reaper
 from z3c.sqlalchemy.interfaces import IModelProvider
 from z3c.sqlalchemy.interfaces import ISQLAlchemyWrapper
 from z3c.sqlalchemy.mapper import LazyMapperCollection
+from z3c.sqlalchemy.mapper import Proxy
+from z3c.sqlalchemy.mapper import columnKeys
 from z3c.sqlalchemy.model import Model
+from z3c.sqlalchemy.model import checkLoaderStrategy
+from z3c.sqlalchemy.profiling import TransactionProfiler
+from z3c.sqlalchemy.reference import ReferenceDataCollection
+from z3c.sqlalchemy.reflection import ReflectionCache
+from z3c.sqlalchemy.routing import ReplicaSet
+from z3c.sqlalchemy.routing import RoutingSession
+from z3c.sqlalchemy.stats import PoolStatistics
+from z3c.sqlalchemy.stats import QueryStatistics
+from z3c.sqlalchemy.stats import poolSize
+
+
+LOG = logging.getLogger('z3c.sqlalchemy')
+
+# expressions for the default schema of databases providing
+# information_schema.columns (used by ZopeWrapper._schemaFingerprint())
+INFORMATION_SCHEMA_DIALECTS = {
+    'postgresql': 'current_schema()',
+    'mysql': 'database()',
+    'mariadb': 'database()',
+    'mssql': 'schema_name()',
+}
 
 
 @implementer(ISQLAlchemyWrapper)
 class ZopeWrapper:
 
+    # engine and sessionmaker, created by _initEngine()
+    _v_engine = None
+    _v_sessionmaker = None
+    _v_pending_sessionmaker = None
+    _v_initializing = False
+    _v_last_used = 0.0
+    _v_disposed = False
+    _replicas = None
+
     def __init__(self, dsn, model=None, transactional=True, twophase=False,
                  engine_options={}, session_options={},
-                 extension_options={}, **kw):
+                 extension_options={}, reflection_cache=None,
+                 replicas=None, replica_strategy='round-robin',
+                 replica_retry_interval=30, query_stats=False,
+                 slow_query_threshold=None, profile_transactions=False,
+                 profile_hook=None, nplusone_threshold=10,
+                 default_lazy='select', defer_types=None, defer_length=None,
+                 result_cache=None, reference_reload_interval=None,
+                 reflection_workers=None, lazy_engine=False, idle_timeout=None,
+                 fork_safe=True, circuit_breaker=None, **kw):
         """ 'dsn' - a RFC-1738-style connection string
 
             'model' - optional instance of model.Model
@@ -42,6 +104,73 @@ class ZopeWrapper:
 
             'transactional' - True|False, only used by SQLAlchemyDA,
                               *don't touch it*
+
+            'reflection_cache' - optional directory used for caching
+            reflected table definitions across processes (SQLite,
+            Postgres, MySQL/MariaDB, MSSQL and Oracle only)
+
+            'replicas' - optional sequence of DSNs of read-only replicas.
+            Read-only statements are sent to a replica chosen according
+            to 'replica_strategy' ('round-robin' or 'least-connections').
+            Replicas failing to connect are skipped for
+            'replica_retry_interval' seconds, reads fail over to the next
+            replica (finally the primary).
+
+            'query_stats' - True|False, record the execution time of all
+            statements per statement fingerprint (see queryStats())
+
+            'slow_query_threshold' - optional number of seconds, statements
+            taking longer are logged to the 'z3c.sqlalchemy.slowquery'
+            logger together with their parameters
+
+            'profile_transactions' - True|False, collect a SQL profile
+            (number of statements, total time, repeated statements and
+            likely N+1 lazy loads) for every transaction. 'profile_hook'
+            is called with the profile of each finished transaction
+            (default: log transactions with relationships lazy loaded at
+            least 'nplusone_threshold' times to the 'z3c.sqlalchemy.profile'
+            logger)
+
+            'default_lazy' - loader strategy of auto-constructed relation
+            properties without an explicit strategy in the model (see
+            Model.add())
+
+            'defer_types' - optional sequence of SQLAlchemy types (e.g.
+            Text, LargeBinary, JSON); columns of these types are loaded
+            only when accessed
+
+            'defer_length' - optional length, string columns longer than
+            this are loaded only when accessed
+
+            'result_cache' - True or a dict with the optional keys
+            'max_entries', 'max_bytes' and 'ttl' (seconds) enabling the
+            result cache used by cached()
+
+            'reference_reload_interval' - optional number of seconds after
+            which the snapshots of reference data tables are reloaded
+
+            'reflection_workers' - optional number of threads used by
+            getMappers(), preload() and warmup() for reflecting the tables
+            of multiple schemas in parallel
+
+            'lazy_engine' - True|False, defer the creation of the engine and
+            the sessionmaker (and importing the DB-API driver) until the
+            wrapper is used for the first time
+
+            'idle_timeout' - optional number of seconds, the connection
+            pool is disposed (all connections are closed) when no
+            connection has been checked out for this time
+
+            'fork_safe' - True|False, reset the connection pools in forked
+            child processes (without closing the connections of the parent)
+            and never check out a connection created by another process
+
+            'circuit_breaker' - True or a dict with the optional keys
+            'threshold' (consecutive connection failures, default: 5) and
+            'cooldown' (seconds, default: 30) enabling a circuit breaker:
+            after 'threshold' failures to connect to the database the
+            session fails immediately with CircuitOpenError for 'cooldown'
+            seconds (see circuitState())
         """
 
         self.dsn = dsn
@@ -59,8 +188,38 @@ class ZopeWrapper:
             self.engine_options.update(echo=kw['echo'])
         self.session_options = session_options
         self.extension_options = extension_options
+        self.replicas = tuple(replicas or ())
+        self.replica_strategy = replica_strategy
+        self.replica_retry_interval = replica_retry_interval
+        self._query_stats = None
+        if query_stats or slow_query_threshold is not None:
+            self._query_stats = QueryStatistics(
+                slow_query_threshold=slow_query_threshold)
+        self._profiler = None
+        if profile_transactions or profile_hook is not None:
+            self._profiler = TransactionProfiler(
+                hook=profile_hook, nplusone_threshold=nplusone_threshold)
+        self._result_cache = None
+        if result_cache:
+            if result_cache is True:
+                result_cache = {}
+            self._result_cache = ResultCache(**result_cache)
+        self._reference_data = ReferenceDataCollection(
+            self, reference_reload_interval)
+        checkLoaderStrategy(default_lazy)
+        self.default_lazy = default_lazy
+        self.reflection_workers = reflection_workers
+        self.defer_types = tuple(defer_types or ())
+        self.defer_length = defer_length
+        self.idle_timeout = idle_timeout
+        self.fork_safe = fork_safe
+        self._circuit = None
+        if circuit_breaker:
+            if circuit_breaker is True:
+                circuit_breaker = {}
+            self._circuit = CircuitBreaker(**circuit_breaker)
+        self._engine_lock = threading.RLock()
         self._model = None
-        self._createEngine()
 
         if model:
 
@@ -89,19 +248,169 @@ class ZopeWrapper:
             if not isinstance(self._model, Model):
                 raise TypeError('_model is not an instance of model.Model')
 
+        self.reflection_cache = None
+        if reflection_cache:
+            backend = self.url.get_backend_name()
+            if type(self)._schemaFingerprint is \
+                    ZopeWrapper._schemaFingerprint and \
+                    backend not in INFORMATION_SCHEMA_DIALECTS and \
+                    backend not in ('sqlite', 'oracle'):
+                raise ValueError("'reflection_cache' is not supported for "
+                                 "'%s' databases (no schema fingerprint)"
+                                 % backend)
+            self.reflection_cache = ReflectionCache(reflection_cache,
+                                                    self.url,
+                                                    self._schemaFingerprint)
+
         # mappers must be initialized at last since we need to acces
         # the 'model' from within the constructor of LazyMapperCollection
         self._mappers = LazyMapperCollection(self)
 
+        if fork_safe:
+            # the engine is protected once it exists (see _initEngine())
+            fork.protect(self, ())
+
+        if not lazy_engine:
+            self._initEngine()
+
+    def _initEngine(self):
+        """ create the engine and the sessionmaker (once) """
+
+        with self._engine_lock:
+            if self._v_sessionmaker is not None or self._v_initializing:
+                # _createEngine() in progress within the current thread
+                return
+            self._v_initializing = True
+            try:
+                self._createEngine()
+                self._v_last_used = time.monotonic()
+                if self.fork_safe:
+                    fork.protect(self, self._allEngines())
+                if self.idle_timeout is not None:
+                    for engine in self._allEngines():
+                        event.listen(engine, 'checkout', self._checkedOut)
+                    reaper.register(self)
+
+                # the reflection cache must be loaded after the model has
+                # been set up since tables defined by the model take
+                # precedence
+                if self.reflection_cache is not None:
+                    self.reflection_cache.load(self._v_engine, self.metadata)
+
+                # other threads use the wrapper once the sessionmaker is
+                # published, so this must happen at last
+                self._v_sessionmaker = self._v_pending_sessionmaker
+            finally:
+                self._v_initializing = False
+                self._v_pending_sessionmaker = None
+
+    @property
+    def _engine(self):
+        if self._v_sessionmaker is None:
+            self._initEngine()
+        return self._v_engine
+
+    @_engine.setter
+    def _engine(self, engine):
+        self._v_engine = engine
+
+    @property
+    def _sessionmaker(self):
+        if self._v_sessionmaker is None:
+            self._initEngine()
+            if self._v_initializing:
+                # used by _createEngine() of the current thread
+                return self._v_pending_sessionmaker
+        return self._v_sessionmaker
+
+    @_sessionmaker.setter
+    def _sessionmaker(self, sessionmaker):
+        if self._v_initializing:
+            # published by _initEngine() once the setup is complete
+            self._v_pending_sessionmaker = sessionmaker
+        else:
+            self._v_sessionmaker = sessionmaker
+
+    def _allEngines(self):
+        """ return all engines of the wrapper (including replicas) """
+
+        engines = [self._v_engine]
+        if self._replicas is not None:
+            engines.extend(self._replicas.engines)
+        return engines
+
+    def _checkedOut(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        self._v_last_used = time.monotonic()
+        self._v_disposed = False
+
+    def _afterFork(self):
+        """ called in a child process after forking: the pooled
+            connections belong to the parent process, they are dropped
+            without being closed
+        """
+
+        # the locks might have been held by other threads while forking
+        self._engine_lock = threading.RLock()
+        self._mappers._afterFork()
+        self._reference_data._afterFork()
+        for helper in (self._query_stats, self._result_cache, self._circuit,
+                       self.reflection_cache):
+            if helper is not None:
+                helper._afterFork()
+
+        if self._v_sessionmaker is None:
+            return
+        self._pool_stats._afterFork()
+        if self._replicas is not None:
+            self._replicas._afterFork()
+        for engine in self._allEngines():
+            engine.dispose(close=False)
+        if self.idle_timeout is not None:
+            # threads do not survive a fork
+            reaper.register(self)
+
+    def _disposeIfIdle(self, now):
+        """ dispose the connection pools if no connection has been checked
+            out for 'idle_timeout' seconds, return True if disposed
+        """
+
+        if self._v_sessionmaker is None or self._v_disposed or \
+                self.idle_timeout is None or \
+                now - self._v_last_used < self.idle_timeout:
+            return False
+
+        engines = self._allEngines()
+        for engine in engines:
+            checkedout = getattr(engine.pool, 'checkedout', None)
+            if checkedout is not None and checkedout():
+                return False
+
+        for engine in engines:
+            engine.dispose()
+        self._v_disposed = True
+        LOG.info('Disposed the idle connection pool of %s',
+                 self.url.render_as_string(hide_password=True))
+        return True
+
     @property
     def metadata(self):
         if not hasattr(self, '_v_metadata'):
             self._v_metadata = MetaData()
         return self._v_metadata
 
+    @property
+    def registry(self):
+        """ The mapper registry shared by all generated mappers """
+        if not hasattr(self, '_v_registry'):
+            self._v_registry = registry(metadata=self.metadata)
+        return self._v_registry
+
     @property
     def session(self):
         """ Return thread-local session """
+        if self._circuit is not None:
+            self._circuit.check()
         return self._sessionmaker()
 
     @property
@@ -120,7 +429,398 @@ class ZopeWrapper:
         return self._mappers.getMapper(tablename, schema)
 
     def getMappers(self, *names):
-        return tuple([self.getMapper(name) for name in names])
+        return self._mappers.getMappers(*names)
+
+    def configure(self):
+        """ Configure all mappers (relationships, backrefs) in advance
+            instead of lazily upon the first query. Returns the time spent
+            (in seconds).
+        """
+
+        start = time.perf_counter()
+        self.registry.configure(cascade=True)
+        duration = time.perf_counter() - start
+        LOG.info('Configured mappers of %s in %.3f seconds',
+                 self.url.render_as_string(hide_password=True), duration)
+        return duration
+
+    def preload(self):
+        """ Reflect and map all tables of the model in advance """
+        if self._model is not None:
+            return self.getMappers(*self._model.names)
+        return ()
+
+    def warmup(self, mappers=True, connections=0):
+        """ Prepare the wrapper for serving requests: reflect and map all
+            tables of the model and configure the mappers ('mappers') and
+            open 'connections' pooled connections in parallel (limited to
+            the size of the pool). Returns the time spent per step (in
+            seconds).
+        """
+
+        timings = {}
+        start = time.perf_counter()
+        if mappers:
+            self.preload()
+            timings['mappers'] = time.perf_counter() - start
+            timings['configure'] = self.configure()
+
+        if connections:
+            step = time.perf_counter()
+            self._fillPool(connections)
+            timings['connections'] = time.perf_counter() - step
+
+        timings['total'] = time.perf_counter() - start
+        LOG.info('Warmed up %s in %.3f seconds',
+                 self.url.render_as_string(hide_password=True),
+                 timings['total'])
+        return timings
+
+    def _fillPool(self, connections):
+        """ open up to 'connections' connections in parallel and return
+            them to the pool
+        """
+
+        size = poolSize(self.engine.pool)
+        if size is not None:
+            connections = min(connections, size)
+        if connections <= 0:
+            return
+
+        # all connections are held until all of them have been opened,
+        # otherwise the same pooled connection would be checked out again
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(self.engine.connect)
+                       for i in range(connections)]
+
+        errors = [future.exception() for future in futures
+                  if future.exception() is not None]
+        for future in futures:
+            if future.exception() is None:
+                future.result().close()
+        if errors:
+            raise errors[0]
+
+    def stream(self, mapper, criteria=None, batch_size=1000, as_dict=False):
+        """ Generator iterating over all rows of 'mapper' (a mapper class
+            or the name of a mapper) matching 'criteria' using a server-side
+            cursor. Rows are fetched in batches of 'batch_size' rows and
+            removed from the session once a batch has been consumed, so
+            memory usage stays flat. The query runs within the session of
+            the current (Zope) transaction.
+
+            'criteria' - None, a dict (passed to filter_by()) or a SQL
+            expression or a sequence of SQL expressions (passed to where())
+
+            'as_dict' - yield dicts (see MappedClassBase.asDict()) instead
+            of mapped objects
+        """
+
+        if isinstance(mapper, str):
+            mapper = self.getMapper(mapper)
+
+        statement = self._selectStatement(mapper, criteria)
+        session = self.session
+        result = session.execute(statement,
+                                 execution_options={'stream_results': True,
+                                                    'yield_per': batch_size})
+        try:
+            for partition in result.scalars().partitions():
+                for obj in partition:
+                    if as_dict:
+                        yield Proxy(obj)
+                    else:
+                        yield obj
+
+                # objects yielded so far are no longer tracked by the session
+                for obj in partition:
+                    if obj in session:
+                        session.expunge(obj)
+        finally:
+            result.close()
+
+    def _selectStatement(self, mapper, criteria=None):
+        """ return a SELECT statement for 'mapper' restricted by 'criteria'
+            (see stream())
+        """
+
+        statement = select(mapper)
+        if isinstance(criteria, dict):
+            statement = statement.filter_by(**criteria)
+        elif isinstance(criteria, (tuple, list)):
+            statement = statement.where(*criteria)
+        elif criteria is not None:
+            statement = statement.where(criteria)
+        return statement
+
+    def cached(self, mapper, criteria=None, as_dict=False, tables=None):
+        """ Return the result of a query from the result cache (requires
+            'result_cache'). 'mapper' is either a mapper (or the name of a
+            mapper) queried with 'criteria' (see stream()) or a SELECT
+            statement. Results are cached per compiled statement and
+            parameters and are invalidated once a transaction writing to
+            one of the tables of the statement commits. Tables written by
+            the current transaction are not served from the cache.
+
+            'tables' - names of the tables the result depends on, required
+            for textual statements (text()), whose tables are unknown
+
+            Queries for mapped objects return a list of detached objects
+            (dicts with as_dict=True), all other queries a list of rows
+            (dicts with as_dict=True).
+        """
+
+        cache = self._result_cache
+        if cache is None:
+            raise ValueError("The wrapper has been created without "
+                             "'result_cache'")
+
+        if isinstance(mapper, str):
+            mapper = self.getMapper(mapper)
+        if isinstance(mapper, type):
+            statement = self._selectStatement(mapper, criteria)
+        else:
+            statement = mapper
+
+        session = self.session
+        if session.autoflush and \
+                (session.new or session.dirty or session.deleted):
+            session.flush()
+
+        compiled = statement.compile(dialect=self.engine.dialect)
+        if tables is not None:
+            tables = set(tables)
+        elif compiled.compile_state is not None:
+            tables = statementTables(compiled.compile_state.statement)
+        else:
+            raise ValueError('cached() needs a Core/ORM select or explicit '
+                             'tables')
+        entity = self._resultEntity(statement)
+        key = (str(compiled), repr(sorted(compiled.params.items())), entity)
+
+        rows = None
+        if tables.isdisjoint(session.info.get(DIRTY_KEY, ())):
+            rows = cache.get(key)
+
+        if rows is None:
+            generation = cache.generation(tables)
+            result = session.execute(statement)
+            if entity is not None:
+                # column values of the mapped objects
+                keys = columnKeys(entity)
+                rows = tuple([tuple([(key, obj.__dict__[key])
+                                     for key in keys if key in obj.__dict__])
+                              for obj in result.scalars()])
+                size = sum([sizeOf([value for key, value in row])
+                            for row in rows])
+            else:
+                rows = tuple(result)
+                size = sum([sizeOf(row) for row in rows])
+            if tables.isdisjoint(session.info.get(DIRTY_KEY, ())):
+                cache.put(key, tables, rows, size, generation)
+
+        if entity is not None:
+            objects = [self._detachedInstance(entity, row) for row in rows]
+            if as_dict:
+                return [Proxy(obj) for obj in objects]
+            return objects
+        if as_dict:
+            return [dict(row._mapping) for row in rows]
+        return list(rows)
+
+    def _resultEntity(self, statement):
+        """ return the mapped class of a statement returning mapped objects
+            or None
+        """
+
+        descriptions = getattr(statement, 'column_descriptions', ())
+        if len(descriptions) == 1 and \
+                descriptions[0]['expr'] is descriptions[0].get('entity'):
+            return descriptions[0]['entity']
+        return None
+
+    def invalidateCache(self, tables=None):
+        """ Remove all results depending on one of 'tables' (a sequence
+            of table names) or all results from the result cache
+        """
+        if self._result_cache is not None:
+            self._result_cache.invalidate(tables)
+
+    def cacheStats(self):
+        """ Return the number of entries, the estimated size and the
+            number of hits and misses of the result cache
+        """
+        if self._result_cache is None:
+            return {}
+        return self._result_cache.statistics()
+
+    def _detachedInstance(self, cls, values):
+        """ return a detached instance of the mapped class 'cls' with the
+            given column values (a sequence of (key, value) tuples)
+        """
+
+        obj = inspect(cls).class_manager.new_instance()
+        for key, value in values:
+            set_committed_value(obj, key, value)
+        make_transient_to_detached(obj)
+        return obj
+
+    def getReferenceData(self, name):
+        """ Return the snapshot of the table 'name' marked as reference
+            data in the model. The snapshot is loaded once per process
+            (outside of any transaction) and shared by all threads. It
+            provides all rows and indexes by primary key (get()) and by
+            the columns given in the model (lookup()).
+        """
+        return self._reference_data.get(name)
+
+    def reloadReferenceData(self, name=None):
+        """ Reload the snapshot of 'name' or of all loaded reference
+            data tables
+        """
+        self._reference_data.reload(name)
+
+    def bulkInsert(self, name, rows, chunk_size=1000):
+        """ Insert an iterable of dicts into the table of the mapper 'name'.
+            The rows are sent in chunks of 'chunk_size' rows using
+            executemany() (multi-row INSERT statements where supported by
+            the dialect) within the session of the current transaction.
+            All rows of a chunk must provide the same keys. Returns a list
+            of per-chunk statistics.
+        """
+
+        table = self._getTable(name)
+        statement = table.insert()
+        return self._bulkExecute(name, lambda chunk: statement, rows,
+                                 chunk_size)
+
+    def bulkUpsert(self, name, rows, chunk_size=1000, index_elements=None):
+        """ Like bulkInsert() but rows conflicting with existing rows on
+            'index_elements' (default: the primary key columns) update the
+            existing rows (INSERT ... ON CONFLICT DO UPDATE for Postgres and
+            SQLite, INSERT ... ON DUPLICATE KEY UPDATE for MySQL). The
+            columns to be updated are taken from the keys of the first row
+            of each chunk.
+        """
+
+        table = self._getTable(name)
+        if index_elements is None:
+            index_elements = [col.name for col in table.primary_key]
+
+        def statement(chunk):
+            return self._upsertStatement(table, chunk[0].keys(),
+                                         index_elements)
+
+        return self._bulkExecute(name, statement, rows, chunk_size)
+
+    def _getTable(self, name):
+        """ return the table of the mapper 'name' """
+        return inspect(self.getMapper(name)).local_table
+
+    def _bulkExecute(self, name, statement, rows, chunk_size):
+        """ execute statement(chunk) for all chunks of 'rows' of the
+            mapper 'name'
+        """
+
+        session = self.session
+        stats = []
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            for bind_arguments, part in self._partitionRows(name, chunk):
+                start = time.perf_counter()
+                session.execute(statement(part), part,
+                                bind_arguments=bind_arguments)
+                stats.append({'chunk': len(stats),
+                              'rows': len(part),
+                              'seconds': time.perf_counter() - start})
+
+        # statements executed outside the ORM must be announced to
+        # zope.sqlalchemy, otherwise the transaction is not committed
+        if stats:
+            mark_changed(session)
+        return stats
+
+    def _partitionRows(self, name, chunk):
+        """ return a list of (bind_arguments, rows) for executing the
+            rows of 'chunk'
+        """
+        return [(None, chunk)]
+
+    def _upsertStatement(self, table, keys, index_elements):
+        """ return a dialect specific INSERT ... ON CONFLICT statement """
+
+        dialect = self.engine.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            statement = insert(table)
+            update = dict([(key, statement.excluded[key]) for key in keys
+                           if key not in index_elements])
+            if not update:
+                return statement.on_conflict_do_nothing(
+                    index_elements=index_elements)
+            return statement.on_conflict_do_update(
+                index_elements=index_elements, set_=update)
+
+        elif dialect in ('mysql', 'mariadb'):
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(table)
+            update = dict([(key, statement.inserted[key]) for key in keys
+                           if key not in index_elements])
+            if not update:
+                return statement.prefix_with('IGNORE')
+            return statement.on_duplicate_key_update(update)
+
+        raise NotImplementedError('bulkUpsert() is not supported for %s' %
+                                  dialect)
+
+    def poolStats(self):
+        """ Return statistics about the connection pool: number of checked
+            out and overflow connections, event counters, a histogram of
+            the time spent waiting for a connection and the age of the
+            open connections.
+        """
+        if self._v_sessionmaker is None:
+            # the engine has not been created yet
+            return PoolStatistics().snapshot(None)
+        return self._pool_stats.snapshot(self._engine.pool)
+
+    def circuitState(self):
+        """ Return the state of the circuit breaker ('closed', 'open' or
+            'half-open'), the number of consecutive connection failures,
+            the seconds until the next attempt, how often the circuit has
+            opened and the number of rejected attempts. None if the wrapper
+            has no circuit breaker.
+        """
+        if self._circuit is None:
+            return None
+        return self._circuit.state()
+
+    def queryStats(self, limit=None):
+        """ Return the execution statistics (count, total, avg, p50, p95,
+            max execution time and number of rows) per statement fingerprint
+            sorted by the total execution time. Requires 'query_stats'.
+        """
+        if self._query_stats is None:
+            return []
+        return self._query_stats.statistics(limit)
+
+    def resetQueryStats(self):
+        if self._query_stats is not None:
+            self._query_stats.reset()
+
+    def checkReplicas(self):
+        """ Probe all replicas and return a mapping URL -> healthy.
+            Unhealthy replicas are taken out of rotation.
+        """
+        if self._replicas is None:
+            return {}
+        return self._replicas.checkHealth()
 
     @property
     def engine(self):
@@ -132,11 +832,89 @@ class ZopeWrapper:
         """ only for private purposes! """
         return self._model
 
+    def _schemaFingerprint(self, connection, schema=None):
+        """ Return a string identifying the current definition of the
+            tables of a given 'schema': the complete DDL for SQLite, all
+            columns and constraints for databases providing
+            information_schema (or the Oracle catalog). Database specific
+            wrappers may provide a faster implementation.
+        """
+
+        dialect = connection.dialect.name
+        if dialect == 'sqlite':
+            master = 'sqlite_master'
+            if schema:
+                master = '"%s".sqlite_master' % schema
+            queries = ['SELECT type, name, sql FROM %s ORDER BY type, name'
+                       % master]
+        elif dialect == 'oracle':
+            queries = [
+                'SELECT table_name, column_name, data_type, data_length,'
+                ' data_precision, data_scale, nullable FROM all_tab_columns'
+                ' WHERE owner = coalesce(upper(:schema), user)'
+                ' ORDER BY table_name, column_id',
+                'SELECT table_name, constraint_name, constraint_type'
+                ' FROM all_constraints'
+                ' WHERE owner = coalesce(upper(:schema), user)'
+                ' ORDER BY table_name, constraint_name']
+        elif dialect in INFORMATION_SCHEMA_DIALECTS:
+            current = INFORMATION_SCHEMA_DIALECTS[dialect]
+            queries = [
+                'SELECT table_name, column_name, data_type, is_nullable,'
+                ' column_default, character_maximum_length,'
+                ' numeric_precision, numeric_scale'
+                ' FROM information_schema.columns'
+                ' WHERE table_schema = coalesce(:schema, %s)'
+                ' ORDER BY table_name, ordinal_position' % current,
+                'SELECT table_name, constraint_name, constraint_type'
+                ' FROM information_schema.table_constraints'
+                ' WHERE table_schema = coalesce(:schema, %s)'
+                ' ORDER BY table_name, constraint_name' % current]
+        else:
+            raise ValueError('No schema fingerprint for %s' % dialect)
+
+        rows = []
+        for query in queries:
+            rows.append([tuple(row) for row in connection.execute(
+                text(query), dict(schema=schema))])
+        return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+
     def _createEngine(self):
         self._engine = create_engine(self.dsn, **self.engine_options)
+        self._pool_stats = PoolStatistics()
+        self._pool_stats.attach(self._engine)
+        if self._query_stats is not None:
+            self._query_stats.attach(self._engine)
+        if self._circuit is not None:
+            # replicas failing to connect are skipped by the ReplicaSet
+            self._circuit.attach(self._engine)
+
+        session_options = dict(self.session_options)
+        self._replicas = None
+        if self.replicas:
+            # stale pooled connections to a replica are detected before
+            # the replica is used (see RoutingSession)
+            replica_options = dict(pool_pre_ping=True)
+            replica_options.update(self.engine_options)
+            self._replicas = ReplicaSet(
+                [create_engine(dsn, **replica_options)
+                 for dsn in self.replicas],
+                strategy=self.replica_strategy,
+                retry_interval=self.replica_retry_interval)
+            session_options.update(class_=RoutingSession,
+                                   replicas=self._replicas)
+
         self._sessionmaker = scoped_session(sessionmaker(bind=self._engine,
                                             autocommit=not self.transactional,
                                             twophase=self.twophase,
                                             autoflush=True,
-                                            **self.session_options))
+                                            **session_options))
+        if self._result_cache is not None:
+            self._result_cache.attach(self._sessionmaker.session_factory)
+        if self._profiler is not None:
+            self._profiler.attach(self._engine,
+                                  self._sessionmaker.session_factory)
+            if self._replicas is not None:
+                for engine in self._replicas.engines:
+                    self._profiler.attachEngine(engine)
         register(self._sessionmaker, **self.extension_options)
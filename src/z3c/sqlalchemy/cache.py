@@ -0,0 +1,195 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Transaction-aware cache of query results
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import Table
+from sqlalchemy import event
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.sql.util import find_tables
+
+
+# key within Session.info: names of the tables written within the current
+# transaction of a session
+DIRTY_KEY = 'z3c.sqlalchemy.dirty'
+
+
+def statementTables(statement):
+    """ return the set of the names of all tables used by 'statement' """
+
+    return set([table.fullname
+                for table in find_tables(statement,
+                                         include_joins=True,
+                                         include_aliases=True,
+                                         include_crud=True)
+                if isinstance(table, Table)])
+
+
+def markDirty(session, tables):
+    """ record that 'tables' (a sequence of table names) have been written
+        within the current transaction of 'session'. Use this for writes
+        the cache can not detect itself (e.g. through the DB-API cursor).
+    """
+
+    session.info.setdefault(DIRTY_KEY, set()).update(tables)
+
+
+def sizeOf(values):
+    """ rough estimation of the memory used by a sequence of values """
+
+    return sys.getsizeof(values) + sum([sys.getsizeof(v) for v in values])
+
+
+class ResultCache:
+    """ A LRU cache of query results bounded by the number of entries
+        ('max_entries') and the estimated memory used by the results
+        ('max_bytes'). Entries expire after 'ttl' seconds. Entries are
+        invalidated per table when a transaction that wrote to the table
+        commits. Writes are detected through the flush and execute events
+        of the sessions.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tables = {}
+        self._generations = {}
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
+
+    def attach(self, sessionmaker):
+        """ register the event listeners with 'sessionmaker' """
+
+        event.listen(sessionmaker, 'after_flush', self._afterFlush)
+        event.listen(sessionmaker, 'do_orm_execute', self._ormExecute)
+        event.listen(sessionmaker, 'after_commit', self._afterCommit)
+        event.listen(sessionmaker, 'after_transaction_end',
+                     self._afterTransactionEnd)
+
+    def generation(self, tables):
+        """ return a token changing whenever one of 'tables' is
+            invalidated
+        """
+        generations = self._generations
+        return tuple([generations.get(table, 0) for table in sorted(tables)])
+
+    def get(self, key):
+        """ return the cached value for 'key' or None """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+                    time.monotonic() > entry[0]:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[3]
+
+    def put(self, key, tables, value, size, generation):
+        """ cache 'value' (using an estimated 'size' bytes) unless one of
+            'tables' has been invalidated since 'generation' was taken
+        """
+
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self._lock:
+            if self.generation(tables) != generation:
+                # the result might be outdated already
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, tables, size, value)
+            self._bytes += size
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and
+                     self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tables=None):
+        """ remove all entries depending on one of 'tables' (a sequence of
+            table names) or all entries
+        """
+
+        with self._lock:
+            if tables is None:
+                tables = list(self._tables)
+                self._entries.clear()
+                self._tables.clear()
+                self._bytes = 0
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                for key in list(self._tables.get(table, ())):
+                    self._remove(key)
+
+    def statistics(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self._hits,
+                    'misses': self._misses}
+
+    def _remove(self, key):
+        expires, tables, size, value = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    def _afterFlush(self, session, flush_context):
+        tables = set()
+        for obj in list(session.new) + list(session.dirty) + \
+                list(session.deleted):
+            tables.update([table.fullname
+                           for table in object_mapper(obj).tables])
+        if tables:
+            markDirty(session, tables)
+
+    def _ormExecute(self, orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or \
+                orm_execute_state.is_delete:
+            markDirty(orm_execute_state.session,
+                      statementTables(orm_execute_state.statement))
+
+    def _afterCommit(self, session):
+        tables = session.info.pop(DIRTY_KEY, None)
+        if tables:
+            self.invalidate(tables)
+
+    def _afterTransactionEnd(self, session, transaction):
+        if transaction.parent is None:
+            # rolled back (or committed and invalidated already)
+            session.info.pop(DIRTY_KEY, None)
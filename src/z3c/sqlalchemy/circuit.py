@@ -0,0 +1,183 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Circuit breaker failing fast while the database is unreachable
+"""
+
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy import exc
+
+
+LOG = logging.getLogger('z3c.sqlalchemy')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(exc.SQLAlchemyError):
+    """ raised instead of connecting while the circuit breaker is open """
+
+
+class CircuitBreaker:
+    """ Counts consecutive failures to connect to the database of the
+        engines it is attached to (including timeouts waiting for a pooled
+        connection). After 'threshold' consecutive failures
+        the circuit opens and all attempts to connect or to check out a
+        pooled connection fail immediately with CircuitOpenError for
+        'cooldown' seconds. Afterwards a single attempt to connect is let
+        through (half-open): its success closes the circuit, its failure
+        opens it again. A probe not finished within 'cooldown' seconds
+        (e.g. interrupted by a BaseException) is given up and the next
+        attempt probes again.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        if threshold < 1:
+            raise ValueError('threshold must be at least 1')
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened = None
+        self._probe_started = None
+        self._trips = 0
+        self._rejected = 0
+
+    def attach(self, engine):
+        """ register the event listeners guarding the connections of
+            'engine' (including the engines derived from it through
+            execution_options())
+        """
+
+        event.listen(engine, 'do_connect', self._doConnect)
+        event.listen(engine, 'connect', self._connect)
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'handle_error', self._handleError)
+        # Engine.dispose() replaces the pool
+        event.listen(engine, 'engine_disposed', self._guardPool)
+        self._guardPool(engine)
+
+    def _guardPool(self, engine):
+        # a pool timeout is no DB-API error, handle_error does not see it
+        pool = engine.pool
+        connect = pool.connect
+
+        def guarded_connect():
+            # fail fast instead of waiting for the pool while open
+            self.check()
+            try:
+                connection = connect()
+            except exc.TimeoutError as e:
+                self._failure(e)
+                raise
+            if self._failures:
+                self._success()
+            return connection
+
+        pool.connect = guarded_connect
+
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
+
+    def check(self):
+        """ raise CircuitOpenError if an attempt to connect would be
+            rejected right now
+        """
+
+        with self._lock:
+            if self._state == OPEN and not self._cooledDown() or \
+                    self._state == HALF_OPEN and not self._probeLost():
+                self._rejected += 1
+                raise self._error()
+
+    def state(self):
+        """ return the state of the circuit as a dict """
+
+        with self._lock:
+            state = self._state
+            retry_in = 0.0
+            if state == OPEN:
+                retry_in = max(0.0, self._opened + self.cooldown -
+                               time.monotonic())
+            return {'state': state,
+                    'failures': self._failures,
+                    'threshold': self.threshold,
+                    'cooldown': self.cooldown,
+                    'retry_in': retry_in,
+                    'trips': self._trips,
+                    'rejected': self._rejected}
+
+    def _cooledDown(self):
+        return time.monotonic() - self._opened >= self.cooldown
+
+    def _probeLost(self):
+        return time.monotonic() - self._probe_started >= self.cooldown
+
+    def _error(self):
+        return CircuitOpenError(
+            'Circuit breaker is %s after %d consecutive connection '
+            'failures' % (self._state, self._failures))
+
+    def _acquire(self):
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN and self._cooledDown() or \
+                    self._state == HALF_OPEN and self._probeLost():
+                # the current thread probes the database
+                self._state = HALF_OPEN
+                self._probe_started = time.monotonic()
+                return
+            self._rejected += 1
+            raise self._error()
+
+    def _doConnect(self, dialect, connection_record, cargs, cparams):
+        self._acquire()
+
+    def _connect(self, dbapi_connection, connection_record):
+        self._success()
+
+    def _checkout(self, dbapi_connection, connection_record,
+                  connection_proxy):
+        if self._state != CLOSED:
+            # the pooled connection is discarded
+            self.check()
+
+    def _handleError(self, context):
+        # errors raised while connecting come without a connection, failing
+        # pre-pings of pooled connections are followed by a reconnect
+        if context.connection is None and not context.is_pre_ping:
+            self._failure(context.original_exception)
+
+    def _success(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                LOG.info('Circuit breaker closed, the database is '
+                         'reachable again')
+            self._state = CLOSED
+            self._failures = 0
+            self._opened = None
+
+    def _failure(self, error):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.threshold:
+                if self._state == CLOSED:
+                    self._trips += 1
+                    LOG.warning('Circuit breaker opened after %d consecutive '
+                                'connection failures (%s)', self._failures,
+                                error)
+                self._state = OPEN
+                self._opened = time.monotonic()
@@ -0,0 +1,67 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Fork safety: connections must never be shared between processes
+"""
+
+import os
+import threading
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy import exc
+
+from z3c.sqlalchemy.idle import reaper
+
+
+PID_KEY = 'z3c.sqlalchemy.pid'
+
+_wrappers = weakref.WeakSet()
+_lock = threading.Lock()
+
+
+def protect(wrapper, engines):
+    """ make the pools of 'engines' (the engines of 'wrapper') fork-safe:
+        the pools are reset in child processes and connections created by
+        another process are never checked out
+    """
+
+    for engine in engines:
+        event.listen(engine, 'connect', _connect)
+        event.listen(engine, 'checkout', _checkout)
+    with _lock:
+        _wrappers.add(wrapper)
+
+
+def _connect(dbapi_connection, connection_record):
+    connection_record.info[PID_KEY] = os.getpid()
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get(PID_KEY, pid) != pid:
+        # the connection belongs to the parent process, it must not be
+        # closed (the pool opens a new connection instead)
+        connection_record.dbapi_connection = None
+        connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid %s, attempting to check out '
+            'in pid %s' % (connection_record.info[PID_KEY], pid))
+
+
+def _afterForkInChild():
+    global _lock
+    # the locks might have been held by another thread while forking
+    _lock = threading.Lock()
+    reaper._afterFork()
+    for wrapper in list(_wrappers):
+        wrapper._afterFork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterForkInChild)
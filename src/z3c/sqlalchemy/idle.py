@@ -0,0 +1,93 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Disposal of idle connection pools
+"""
+
+import logging
+import threading
+import time
+import weakref
+
+
+LOG = logging.getLogger('z3c.sqlalchemy')
+
+
+class IdleReaper:
+    """ A daemon thread periodically asking all registered wrappers to
+        dispose their connection pools if they have been idle for longer
+        than their 'idle_timeout'. The wrappers are referenced weakly.
+    """
+
+    # upper bound of the time between two checks (in seconds)
+    max_interval = 60.0
+
+    def __init__(self):
+        self._wrappers = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def register(self, wrapper):
+        with self._lock:
+            self._wrappers.add(wrapper)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='z3c.sqlalchemy idle reaper',
+                    daemon=True)
+                self._thread.start()
+            else:
+                # the new wrapper might require a shorter interval
+                self._wakeup.set()
+
+    def unregister(self, wrapper):
+        with self._lock:
+            self._wrappers.discard(wrapper)
+            self._wakeup.set()
+
+    def _afterFork(self):
+        # called in a child process: the thread does not exist there and
+        # the locks might have been held by another thread while forking
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def reap(self):
+        """ dispose the pools of all idle wrappers, return the number of
+            disposed wrappers
+        """
+
+        now = time.monotonic()
+        disposed = 0
+        for wrapper in list(self._wrappers):
+            try:
+                if wrapper._disposeIfIdle(now):
+                    disposed += 1
+            except Exception:
+                LOG.exception('Disposing the pool of %r failed', wrapper)
+        return disposed
+
+    def _interval(self):
+        timeouts = [wrapper.idle_timeout for wrapper in list(self._wrappers)]
+        if not timeouts:
+            return self.max_interval
+        return max(0.1, min(self.max_interval, min(timeouts) / 2.0))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval())
+            self._wakeup.clear()
+            with self._lock:
+                if not self._wrappers:
+                    # started again by the next register()
+                    self._thread = None
+                    return
+            self.reap()
+
+
+reaper = IdleReaper()
@@ -13,9 +13,9 @@ from zope.schema import Int
 from zope.schema import TextLine
 
 
-class ISQLAlchemyWrapper(Interface):
-    """ A SQLAlchemyWrapper wraps sqlalchemy and deals with
-        connection and transaction handling.
+class IBaseSQLAlchemyWrapper(Interface):
+    """ The API shared by the synchronous and the asynchronous wrappers
+        (getMapper() etc. are coroutines for IAsyncSQLAlchemyWrapper)
     """
 
     dsn = TextLine(title='A RFC-1738 style connection string',
@@ -53,6 +53,67 @@ class ISQLAlchemyWrapper(Interface):
             ATT: Schema support?
         """
 
+    def preload():
+        """ reflect and map all tables of the model in advance """
+
+    def configure():
+        """ configure all mappers in advance and return the time spent """
+
+    def warmup(mappers=True, connections=0):
+        """ reflect, map and configure all tables of the model and open
+            'connections' pooled connections in advance. Returns the time
+            spent per step.
+        """
+
+    def stream(mapper, criteria=None, batch_size=1000, as_dict=False):
+        """ iterate over all rows of a mapper (or a mapper given by its name)
+            matching 'criteria' in batches of 'batch_size' rows using a
+            server-side cursor. Yields mapped objects or dicts (as_dict=True).
+        """
+
+    def poolStats():
+        """ return statistics about the connection pool """
+
+    def circuitState():
+        """ return the state of the circuit breaker (None if disabled) """
+
+    def bulkInsert(name, rows, chunk_size=1000):
+        """ insert an iterable of dicts in chunks into the table of the
+            mapper 'name' and return per-chunk statistics
+        """
+
+    def bulkUpsert(name, rows, chunk_size=1000, index_elements=None):
+        """ insert or update (on conflicting 'index_elements') an iterable
+            of dicts in chunks and return per-chunk statistics
+        """
+
+
+class ISQLAlchemyWrapper(IBaseSQLAlchemyWrapper):
+    """ A SQLAlchemyWrapper wraps sqlalchemy and deals with
+        connection and transaction handling.
+    """
+
+    def cached(mapper, criteria=None, as_dict=False, tables=None):
+        """ return the (cached) result of a query for a mapper (or a
+            mapper given by its name) matching 'criteria' or of a SELECT
+            statement as detached objects, rows or dicts (as_dict=True).
+            Textual statements require the names of their 'tables'.
+        """
+
+    def getReferenceData(name):
+        """ return the process-wide snapshot of the reference data
+            table 'name'
+        """
+
+
+class IAsyncSQLAlchemyWrapper(IBaseSQLAlchemyWrapper):
+    """ A wrapper based on the asyncio extension of SQLAlchemy. The
+        sessions do not participate in Zope transactions.
+    """
+
+    def remove():
+        """ close the session of the current task (coroutine) """
+
 
 class IModelProvider(Interface):
     """ A model providers provides information about the tables to be used
@@ -75,7 +136,8 @@ class IModel(Interface):
     """
 
     def add(name, table=None, mapper_class=None, relations=None,
-            autodetect_relations=False, table_name=None):
+            autodetect_relations=False, table_name=None, cascade=None,
+            lazy=None, deferred=None, reference=False):
         """ 'name'  -- name of table (no schema support so far!)
 
             'table' -- a sqlalchemy.Table instance (None, for autoloading)
@@ -94,6 +156,20 @@ class IModel(Interface):
             'table_name' -- optional full name of a table (e.g.
             'someschema.sometable') if you want to use 'name' as alias for
             the table.
+
+            'cascade' -- optional cascade parameter directly passed to the
+            relation() call
+
+            'lazy' -- optional loader strategy (or dict mapping relation
+            names to loader strategies) of the auto-constructed relation
+            properties
+
+            'deferred' -- optional sequence of names of columns (or dict
+            mapping group names to sequences of column names) loaded only
+            when accessed
+
+            'reference' -- True or a sequence of names of indexed columns
+            marks the table as reference data
         """
 
     def items():
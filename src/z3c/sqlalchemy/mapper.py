@@ -9,40 +9,89 @@
 Utility methods for SqlAlchemy
 """
 
+import re
 import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
+from sqlalchemy import MetaData
+from sqlalchemy import String
 from sqlalchemy import Table
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import deferred
 from sqlalchemy.orm import registry
 from sqlalchemy.orm import relationship
 
 
 marker = object
 
+DEFAULT_SCHEMA = 'public'
+
+# group of the columns deferred through the 'defer_types' and
+# 'defer_length' options of the wrapper
+DEFERRED_GROUP = 'deferred'
+
+
+# mapped class -> (keys, getter), classes of discarded wrappers are freed
+_column_getters = weakref.WeakKeyDictionary()
+
+
+def _columnGetter(cls):
+    """ return a (cached) tuple (keys, getter) for a mapped class. 'keys'
+        are the keys of all column properties in mapper order, 'getter'
+        fetches the values of these keys from an instance dict in one pass.
+    """
+
+    try:
+        return _column_getters[cls]
+    except KeyError:
+        keys = tuple([prop.key for prop in class_mapper(cls).column_attrs])
+        if len(keys) == 1:
+            def getter(state, key=keys[0]):
+                return (state[key],)
+        else:
+            getter = itemgetter(*keys)
+        _column_getters[cls] = keys, getter
+        return keys, getter
+
+
+def columnKeys(cls):
+    """ return the keys of all column properties of a mapped class """
+    return _columnGetter(cls)[0]
+
+
+_getitem = dict.__getitem__
+
 
 class Proxy(dict):
     """ Dict-Proxy for mapped objects providing
         attribute-style access.
     """
 
+    __slots__ = ()
+
     def __init__(self, obj):
-        super(dict, self).__init__()
-        self.update(obj.__dict__.copy())
+        keys, getter = _columnGetter(obj.__class__)
+        state = obj.__dict__
+        try:
+            dict.__init__(self, zip(keys, getter(state)))
+        except KeyError:
+            # some columns are deferred or expired, they are not loaded
+            # for the sake of a dict
+            dict.__init__(self, [(key, state[key]) for key in keys
+                                 if key in state])
         for attr in getattr(obj, 'proxied_properties', ()):
             self[attr] = getattr(obj, attr)
-        del self['_sa_instance_state']
 
     def __getattribute__(self, name):
-        if name in dict.keys(self):
-            return self.get(name)
-
-        return super(dict, self).__getattribute__(name)
-
-    def __getattr__(self, name, default=None):
-        if name in dict.keys(self):
-            return self.get(name, default)
-        return super(dict, self).__getattr__(name, default)
+        # keys take precedence over regular attributes
+        try:
+            return _getitem(self, name)
+        except KeyError:
+            return object.__getattribute__(self, name)
 
 
 class MappedClassBase:
@@ -51,6 +100,9 @@ class MappedClassBase:
     # Zope 2 security magic.......buuuuuuuhhhhhh
     __allow_access_to_unprotected_subobjects__ = 1
 
+    # names of additional (non-column) attributes included by asDict()
+    proxied_properties = ()
+
     def __init__(self, **kw):
         """ accepts keywords arguments used for initialization of
             mapped attributes/columns.
@@ -67,7 +119,7 @@ class MappedClassBase:
         """
 
         d = dict()
-        for col in self.c.keys():
+        for col in columnKeys(self.__class__):
             d[col] = getattr(self, col)
         return self.__class__(**d)
 
@@ -91,13 +143,69 @@ class MappedClassBase:
             return class_mapper(self.__class__).props[name].mapper.class_
 
 
+def deferredColumns(table, columns=None, defer_types=None,
+                    defer_length=None):
+    """ return a dict column key -> group (or None) of the columns of
+        'table' to be deferred. 'columns' is a sequence of column names or
+        a dict mapping group names to sequences of column names (see
+        Model.add()). Columns of one of the 'defer_types' and string
+        columns longer than 'defer_length' are deferred as group
+        DEFERRED_GROUP. Primary key columns are never deferred.
+    """
+
+    result = {}
+    if defer_types or defer_length is not None:
+        for col in table.columns:
+            if col.primary_key:
+                continue
+            if defer_types and isinstance(col.type, tuple(defer_types)):
+                result[col.key] = DEFERRED_GROUP
+            elif defer_length is not None and \
+                    isinstance(col.type, String) and \
+                    (col.type.length or 0) > defer_length:
+                result[col.key] = DEFERRED_GROUP
+
+    if columns:
+        if not isinstance(columns, dict):
+            columns = {None: columns}
+        for group, names in columns.items():
+            for name in names:
+                if name not in table.columns:
+                    raise ValueError('Table %s has no column %r' %
+                                     (table.fullname, name))
+                if table.columns[name].primary_key:
+                    raise ValueError('Primary key column %r of table %s '
+                                     'can not be deferred' %
+                                     (name, table.fullname))
+                result[table.columns[name].key] = group
+    return result
+
+
+def _reflect(metadata, bind, schema, tablenames):
+    """ reflect the tables 'tablenames' of 'schema' into 'metadata' """
+
+    metadata.reflect(bind=bind,
+                     schema=schema,
+                     views=True,
+                     only=lambda tname, metadata: tname in tablenames)
+
+
 class MapperFactory:
     """ a factory for table and mapper objects """
 
-    def __init__(self, metadata):
+    def __init__(self, metadata, mapper_registry=None):
         self.metadata = metadata
+        if mapper_registry is None:
+            mapper_registry = registry(metadata=metadata)
+        self.registry = mapper_registry
+        self._class_names = set()
+        self._lock = threading.Lock()
+
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
 
-    def __call__(self, table, properties={}, cls=None):
+    def __call__(self, table, properties={}, cls=None, name=None):
         """ Returns a tuple (mapped_class, table_class).
             'table' - sqlalchemy.Table to be mapped
 
@@ -105,16 +213,34 @@ class MapperFactory:
 
             'cls' - (optional) class used as base for creating the mapper
             class (will be autogenerated if not available).
+
+            'name' - (optional) name of the mapper, used for naming the
+            autogenerated class (default: the name of the table)
         """
 
         if cls is None:
-            newCls = type('_mapped_%s' % str(table.name),
+            newCls = type(self._className(name or table.fullname),
                           (MappedClassBase,), {})
         else:
             newCls = cls
-        registry().map_imperatively(newCls, table, properties=properties)
+        self.registry.map_imperatively(newCls, table, properties=properties)
         return newCls
 
+    def _className(self, name):
+        """ return a class name for the mapper 'name' that is unique
+            within the registry shared by all mappers
+        """
+
+        base = '_mapped_%s' % re.sub(r'\W', '_', name)
+        with self._lock:
+            class_name = base
+            count = 1
+            while class_name in self._class_names:
+                count += 1
+                class_name = '%s_%d' % (base, count)
+            self._class_names.add(class_name)
+        return class_name
+
 
 class LazyMapperCollection(dict):
     """ Implements a cache for table mappers """
@@ -122,113 +248,295 @@ class LazyMapperCollection(dict):
     def __init__(self, wrapper):
         super().__init__()
         self._wrapper = wrapper
-        self._engine = wrapper.engine
         self._model = wrapper.model or {}
         self._metadata = wrapper.metadata
-        self._mapper_factory = MapperFactory(self._metadata)
+        self._mapper_factory = MapperFactory(self._metadata, wrapper.registry)
         self._dependent_tables = None
+        self._default_lazy = wrapper.default_lazy
+        self._reflection_workers = wrapper.reflection_workers or 1
         self._lock = threading.Lock()
+        self._locks = {}
+        # MetaData is not thread-safe, reflection into it is serialized
+        self._metadata_lock = threading.RLock()
 
-    def getMapper(self, name, schema='public'):
-        """ return a (cached) mapper class for a given table 'name' """
+    @property
+    def _engine(self):
+        # the engine of the wrapper might be created lazily
+        return self._wrapper.engine
 
-        if name not in self:
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._metadata_lock = threading.RLock()
+        self._mapper_factory._afterFork()
 
-            # no-cached data, let's lookup the table ourselfs
-            table = None
+    def getMapper(self, name, schema='public', bind=None):
+        """ return a (cached) mapper class for a given table 'name'.
+            'bind' is an optional engine or connection used for reflection.
+        """
 
-            # check if the optional model provides a table definition
-            if name in self._model:
-                table = self._model[name].get('table')
+        # lock-free fast path for already generated mappers
+        try:
+            return self[name]
+        except KeyError:
+            pass
 
-                # support for SA declarative layer
-                mapper_class = self._model[name].get('mapper_class')
-                if isinstance(mapper_class, DeclarativeMeta):
-                    self._registerMapper(mapper_class, name)
-                    return mapper_class
+        # single-flight: only the first caller reflects and maps the table,
+        # concurrent callers wait for the mapper generated by the first one
+        with self._nameLock(name):
+            if name not in self:
+                self._createMapper(name, schema, bind)
 
-            # if not: introspect table definition
-            if table is None:
+        return self[name]
+
+    def _createMapper(self, name, schema, bind=None):
+        """ reflect (if necessary) and map the table for 'name' """
 
-                tname = self._model.get(name, {}).get('table_name')
-                table_name = tname or name
-
-                # check for 'schema.tablename'
-                if '.' in table_name:
-                    schema, tablename = table_name.split('.')
-                else:
-                    tablename, schema = table_name, None
-
-                table = Table(tablename,
-                              self._metadata,
-                              schema=schema,
-                              autoload_with=self._engine)
-
-            # check if the model contains an optional mapper class
-            mapper_class = None
-            if name in self._model:
-                mapper_class = self._model[name].get('mapper_class')
-
-            # use auto-introspected table dependencies for creating
-            # the 'properties' dict that tells the mapper about
-            # relationships to other tables
-
-            dependent_table_names = []
-            if name in self._model:
-
-                adr = self._model[name].get('autodetect_relations', False)
-
-                if self._model[name].get('relations') is not None:
-                    dependent_table_names = self._model[name].get('relations',
-                                                                  []) or []
-                elif adr is True:
-
-                    if self._dependent_tables is None:
-                        # Introspect table dependencies once. The introspection
-                        # is deferred until the moment where we really need to
-                        # introspect them
-                        meth = getattr(self._wrapper,
-                                       'findDependentTables',
-                                       None)
-                        if meth is not None:
-                            self._dependent_tables = meth(ignoreErrors=True)
-                        else:
-                            self._dependent_tables = {}
-
-                    dependent_table_names = (
-                        self._dependent_tables.get(name, []) or [])
-
-            # build additional property dict for mapper
-            properties = {}
-
-            # find all dependent tables (referencing the current table)
-            for table_refname in dependent_table_names:
-                # create or get a mapper for the referencing table
-                table_ref_mapper = self.getMapper(table_refname)
-
-                # add the mapper as relation to the properties dict
-                properties[table_refname] = (
-                    relationship(
-                        table_ref_mapper,
-                        cascade=self._model.get(name, {}).get('cascade'),
-                    )
+        if bind is None:
+            bind = self._engine
+
+        # no-cached data, let's lookup the table ourselfs
+        table = None
+
+        # check if the optional model provides a table definition
+        if name in self._model:
+            table = self._model[name].get('table')
+
+            # support for SA declarative layer
+            mapper_class = self._model[name].get('mapper_class')
+            if isinstance(mapper_class, DeclarativeMeta):
+                self._registerMapper(mapper_class, name)
+                return mapper_class
+
+        # if not: introspect table definition
+        if table is None:
+
+            schema, tablename = self._tableName(name)
+            table = self._metadata.tables.get(
+                self._tableKey(schema, tablename))
+
+            if table is None:
+                with self._metadata_lock:
+                    table = Table(tablename,
+                                  self._metadata,
+                                  schema=schema,
+                                  autoload_with=bind)
+
+                cache = self._wrapper.reflection_cache
+                if cache is not None:
+                    # written in batches, see ReflectionCache
+                    cache.add(table)
+                    cache.scheduleSave(self._engine)
+
+        # check if the model contains an optional mapper class
+        mapper_class = None
+        if name in self._model:
+            mapper_class = self._model[name].get('mapper_class')
+
+        # use auto-introspected table dependencies for creating
+        # the 'properties' dict that tells the mapper about
+        # relationships to other tables
+
+        dependent_table_names = []
+        if name in self._model:
+
+            adr = self._model[name].get('autodetect_relations', False)
+
+            if self._model[name].get('relations') is not None:
+                dependent_table_names = self._model[name].get('relations',
+                                                              []) or []
+            elif adr is True:
+
+                if self._dependent_tables is None:
+                    # Introspect table dependencies once. The introspection
+                    # is deferred until the moment where we really need to
+                    # introspect them
+                    meth = getattr(self._wrapper,
+                                   'findDependentTables',
+                                   None)
+                    if meth is not None:
+                        self._dependent_tables = meth(
+                            schema=self._modelSchemas(), ignoreErrors=True)
+                    else:
+                        self._dependent_tables = {}
+
+                schema, tablename = self._tableName(name)
+                if schema not in (None, DEFAULT_SCHEMA):
+                    tablename = self._tableKey(schema, tablename)
+                dependent_table_names = (
+                    self._dependent_tables.get(tablename, []) or [])
+
+        # build additional property dict for mapper
+        properties = {}
+
+        # loader strategy of the relations: per relation, per table or
+        # the default of the wrapper
+        lazy = self._model.get(name, {}).get('lazy')
+        if not isinstance(lazy, dict):
+            lazy = dict.fromkeys(dependent_table_names, lazy)
+
+        # find all dependent tables (referencing the current table)
+        for table_refname in dependent_table_names:
+            # create or get a mapper for the referencing table
+            table_ref_mapper = self.getMapper(table_refname, bind=bind)
+
+            # add the mapper as relation to the properties dict
+            properties[table_refname] = (
+                relationship(
+                    table_ref_mapper,
+                    cascade=self._model.get(name, {}).get('cascade'),
+                    lazy=lazy.get(table_refname) or self._default_lazy,
                 )
+            )
+
+        # columns loaded on access only
+        for key, group in deferredColumns(
+                table,
+                self._model.get(name, {}).get('deferred'),
+                self._wrapper.defer_types,
+                self._wrapper.defer_length).items():
+            properties.setdefault(key, deferred(table.columns[key],
+                                                group=group))
+
+        # create a mapper and cache it
+        if mapper_class and 'c' in mapper_class.__dict__:
+            mapper = mapper_class
+        else:
+            mapper = self._mapper_factory(table,
+                                          properties=properties,
+                                          cls=mapper_class,
+                                          name=name)
+
+        self._registerMapper(mapper, name)
+
+    def getMappers(self, *names, bind=None):
+        """ return a tuple of (cached) mapper classes for the given table
+            names. All tables (including the tables of explicitly configured
+            relations) that have not been reflected so far are reflected in
+            one pass per schema.
+        """
 
-            # create a mapper and cache it
-            if mapper_class and 'c' in mapper_class.__dict__:
-                mapper = mapper_class
-            else:
-                mapper = self._mapper_factory(table,
-                                              properties=properties,
-                                              cls=mapper_class)
+        self._reflectTables(names, bind)
+        return tuple([self.getMapper(name, bind=bind) for name in names])
 
-            self._registerMapper(mapper, name)
+    def _reflectTables(self, names, bind=None):
+        """ reflect all tables required for the mappers of 'names' using
+            a single MetaData.reflect() call per schema.
+        """
 
-        return self[name]
+        if bind is None:
+            bind = self._engine
+
+        missing = {}
+        seen = set()
+        names = list(names)
+
+        while names:
+            name = names.pop()
+            if name in seen or name in self:
+                continue
+            seen.add(name)
+
+            entry = self._model.get(name, {})
+            names.extend(entry.get('relations') or ())
+            if entry.get('table') is not None or \
+                    isinstance(entry.get('mapper_class'), DeclarativeMeta):
+                continue
+
+            schema, tablename = self._tableName(name)
+            if self._tableKey(schema, tablename) not in self._metadata.tables:
+                missing.setdefault(schema, set()).add(tablename)
+
+        # unknown tables are skipped silently here, getMapper() will
+        # raise NoSuchTableError for them later on
+        if self._reflection_workers > 1 and len(missing) > 1 and \
+                isinstance(bind, Engine):
+            self._reflectParallel(missing, bind)
+        else:
+            for schema, tablenames in missing.items():
+                with self._metadata_lock:
+                    _reflect(self._metadata, bind, schema, tablenames)
+
+        cache = self._wrapper.reflection_cache
+        for schema, tablenames in missing.items():
+            if cache is not None:
+                for tablename in tablenames:
+                    table = self._metadata.tables.get(
+                        self._tableKey(schema, tablename))
+                    if table is not None:
+                        cache.add(table)
+
+        if missing and cache is not None:
+            cache.flush(self._engine)
+
+    def _reflectParallel(self, missing, engine):
+        """ reflect the tables of multiple schemas ('missing' maps schemas
+            to sets of table names) in parallel. Every schema is reflected
+            into a private MetaData through a connection of its own, the
+            results are merged into the MetaData of the wrapper.
+        """
+
+        def reflect(item):
+            schema, tablenames = item
+            metadata = MetaData()
+            with engine.connect() as connection:
+                _reflect(metadata, connection, schema, tablenames)
+            return metadata
+
+        workers = min(self._reflection_workers, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(reflect, missing.items()))
+
+        with self._metadata_lock:
+            for metadata in results:
+                for key, table in metadata.tables.items():
+                    # referenced tables may have been reflected by more
+                    # than one worker
+                    if key not in self._metadata.tables:
+                        table.to_metadata(self._metadata)
+
+    def _tableName(self, name):
+        """ return a tuple (schema, tablename) for a mapper 'name' """
+
+        tname = self._model.get(name, {}).get('table_name')
+        table_name = tname or name
+
+        # check for 'schema.tablename'
+        if '.' in table_name:
+            schema, tablename = table_name.split('.')
+        else:
+            tablename, schema = table_name, None
+        return schema, tablename
+
+    def _modelSchemas(self):
+        """ return the default schema followed by all other schemas
+            referenced through 'table_name' by the model
+        """
+
+        schemas = [DEFAULT_SCHEMA]
+        for name in self._model:
+            schema, tablename = self._tableName(name)
+            if schema is not None and schema not in schemas:
+                schemas.append(schema)
+        return schemas
+
+    def _tableKey(self, schema, tablename):
+        """ return the key of a table within the MetaData """
+        return schema and '%s.%s' % (schema, tablename) or tablename
+
+    def _nameLock(self, name):
+        """ return the lock guarding the generation of the mapper 'name' """
+
+        with self._lock:
+            lock = self._locks.get(name)
+            if lock is None:
+                # re-entrant since relations are resolved recursively
+                lock = self._locks[name] = threading.RLock()
+        return lock
 
     def _registerMapper(self, mapper, name):
         """ register a mapper under a given name """
 
-        self._lock.acquire()
-        self[name] = mapper
-        self._lock.release()
+        with self._lock:
+            self[name] = mapper
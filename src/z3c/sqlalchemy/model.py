@@ -17,6 +17,11 @@ from .interfaces import IModel
 
 __all__ = ('Model',)
 
+# loader strategies supported for auto-constructed relation properties
+# (the 'lazy' parameter of sqlalchemy.orm.relationship())
+LOADER_STRATEGIES = ('select', 'selectin', 'joined', 'subquery', 'immediate',
+                     'raise', 'raise_on_sql', 'noload')
+
 
 @implementer(IModel)
 class Model(dict):
@@ -37,7 +42,8 @@ class Model(dict):
             self.add(**d)
 
     def add(self, name, table=None, mapper_class=None, relations=None,
-            autodetect_relations=False, table_name=None, cascade=None):
+            autodetect_relations=False, table_name=None, cascade=None,
+            lazy=None, deferred=None, reference=False):
         """ 'name'  -- name of table (no schema support so far!)
 
             'table' -- a sqlalchemy.Table instance (None, for autoloading)
@@ -59,6 +65,23 @@ class Model(dict):
 
             'cascade' -- optional cascade parameter directly passed to the
             relation() call
+
+            'lazy' -- optional loader strategy of the auto-constructed
+            relation properties ('select', 'selectin', 'joined', 'subquery',
+            'immediate', 'raise', 'raise_on_sql' or 'noload'). Either a
+            single strategy used for all relations or a dict mapping
+            relation names to strategies. Relations without a strategy use
+            the 'default_lazy' strategy of the wrapper.
+
+            'deferred' -- optional sequence of names of columns which are
+            loaded only when accessed, or a dict mapping group names to
+            sequences of column names (all columns of a group are loaded
+            together when one of them is accessed)
+
+            'reference' -- True or a sequence of column names marks the
+            table as reference data loaded once per process (see
+            getReferenceData() of the wrapper). Besides the primary key,
+            the snapshot is indexed by the given columns.
         """
 
         if table is not None and not isinstance(table, sqlalchemy.Table):
@@ -86,6 +109,41 @@ class Model(dict):
             raise ValueError("'relations' and 'autodetect_relations' can't "
                              "be specified at the same time")
 
+        if lazy is not None:
+
+            if isinstance(lazy, str):
+                strategies = [lazy]
+            elif isinstance(lazy, dict):
+                strategies = lazy.values()
+            else:
+                raise TypeError(
+                    'lazy must be specified as string or dict')
+
+            for strategy in strategies:
+                checkLoaderStrategy(strategy)
+
+        if deferred is not None:
+
+            if isinstance(deferred, dict):
+                groups = deferred.values()
+            else:
+                groups = [deferred]
+
+            for columns in groups:
+                if not isinstance(columns, (tuple, list)) or \
+                        not all([isinstance(c, str) for c in columns]):
+                    raise TypeError(
+                        'deferred must be specified as sequence of strings '
+                        'or dict of sequences of strings')
+
+        if reference not in (True, False):
+
+            if not isinstance(reference, (tuple, list)) or \
+                    not all([isinstance(c, str) for c in reference]):
+                raise TypeError(
+                    'reference must be specified as boolean or sequence '
+                    'of strings')
+
         self.names.append(name)
 
         self[name] = {'name': name,
@@ -95,6 +153,9 @@ class Model(dict):
                       'autodetect_relations': autodetect_relations,
                       'cascade': cascade,
                       'table_name': table_name,
+                      'lazy': lazy,
+                      'deferred': deferred,
+                      'reference': reference,
                       }
 
     def items(self):
@@ -104,6 +165,14 @@ class Model(dict):
             yield name, self[name]
 
 
+def checkLoaderStrategy(strategy):
+    """ raise a ValueError for unsupported loader strategies """
+
+    if strategy not in LOADER_STRATEGIES:
+        raise ValueError('Unknown loader strategy %r (use one of %s)' %
+                         (strategy, ', '.join(LOADER_STRATEGIES)))
+
+
 if __name__ == '__main__':
 
     m = Model()
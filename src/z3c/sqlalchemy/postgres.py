@@ -5,17 +5,100 @@
 # Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
 # and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
 ##########################################################################
-import sys
+import io
+import logging
 import threading
 
 import sqlalchemy
 from zope.interface import implementer
+from zope.sqlalchemy import mark_changed
 
 from .base import ZopeWrapper
+from .cache import markDirty
 from .interfaces import ISQLAlchemyWrapper
 
 
-_cache = threading.local()  # module-level cache
+LOG = logging.getLogger('z3c.sqlalchemy')
+
+# formats supported by COPY
+COPY_FORMATS = ('csv', 'text', 'binary')
+
+# all foreign key constraints of the given schemas in one round trip
+DEPENDENT_TABLES_SQL = sqlalchemy.text(
+    "SELECT DISTINCT"
+    " rn.nspname AS referenced_schema, rc.relname AS referenced_table,"
+    " cn.nspname AS referencing_schema, cc.relname AS referencing_table"
+    " FROM pg_constraint con"
+    " JOIN pg_class cc ON cc.oid = con.conrelid"
+    " JOIN pg_namespace cn ON cn.oid = cc.relnamespace"
+    " JOIN pg_class rc ON rc.oid = con.confrelid"
+    " JOIN pg_namespace rn ON rn.oid = rc.relnamespace"
+    " WHERE con.contype = 'f' AND cn.nspname IN :schemas"
+    " ORDER BY referenced_schema, referenced_table,"
+    " referencing_schema, referencing_table"
+).bindparams(sqlalchemy.bindparam('schemas', expanding=True))
+
+
+def _csvField(value):
+    """ encode a single value for COPY ... WITH (FORMAT csv). Strings are
+        always quoted in order to distinguish empty strings from NULL
+        (an unquoted empty field).
+    """
+
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"%s"' % value.replace('"', '""')
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '"\\x%s"' % bytes(value).hex()
+    return str(value)
+
+
+def _copyFormat(format):
+    """ validate the format of a COPY statement """
+
+    if not isinstance(format, str) or format.lower() not in COPY_FORMATS:
+        raise ValueError('Unsupported COPY format %r (use one of %s)' %
+                         (format, ', '.join(COPY_FORMATS)))
+    return format.lower()
+
+
+class RowReader(io.RawIOBase):
+    """ A readable file-like object encoding an iterable of row sequences
+        as CSV on the fly. Rows are only consumed as far as necessary for
+        satisfying the requested amount of data.
+    """
+
+    def __init__(self, rows, encoding='utf-8'):
+        super().__init__()
+        self._rows = iter(rows)
+        self._encoding = encoding
+        self._data = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = [self._data]
+        length = len(self._data)
+        for row in self._rows:
+            line = ','.join([_csvField(value) for value in row]) + '\n'
+            line = line.encode(self._encoding)
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+
+        data = b''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._data = data[size:]
+        return data[:size]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
 
 
 @implementer(ISQLAlchemyWrapper)
@@ -25,48 +108,173 @@ class PostgresMixin:
     def findDependentTables(self, schema='public', ignoreErrors=False):
         """ Returns a mapping tablename -> [list of referencing table(names)].
             ATT: this method is specific to Postgres databases!
-            ATT: This method is limited to a particular schema.
-        """
 
-        if not hasattr(_cache, 'ref_mapping'):
+            'schema' can be a single schema name or a sequence of schema
+            names. Tables of the first schema are reported by their plain
+            name, tables of all other schemas as 'schema.tablename'.
 
-            d = {}
-            db = self._engine
-            sql = "select * from pg_tables where schemaname = '%s'"
-            rs = db.execute(sql % schema)
+            The result is computed by a single catalog query and cached
+            per wrapper and DSN.
+        """
 
-            for row in rs:
-                tablename = row.tablename
+        if isinstance(schema, str):
+            schemas = (schema,)
+        else:
+            schemas = tuple(schema)
 
+        key = (self.dsn, schemas)
+        # a lock per wrapper, the catalog query of one wrapper must not
+        # block the others (dict.setdefault() is atomic)
+        lock = self.__dict__.setdefault('_v_dependent_tables_lock',
+                                        threading.Lock())
+        with lock:
+            cache = self.__dict__.setdefault('_v_dependent_tables', {})
+            if key not in cache:
                 try:
-                    table = sqlalchemy.Table(tablename, db, autoload=True)
-                except KeyError:
-                    if ignoreErrors:
-                        print('Can\'t load table %s' % tablename,
-                              file=sys.stderr)
-                        continue
-                    else:
+                    cache[key] = self._queryDependentTables(schemas)
+                except sqlalchemy.exc.DBAPIError:
+                    if not ignoreErrors:
                         raise
+                    LOG.warning('Can\'t introspect dependent tables of %s',
+                                ', '.join(schemas), exc_info=True)
+                    return {}
+            return cache[key]
+
+    def _afterFork(self):
+        # the lock might have been held by another thread while forking
+        self.__dict__.pop('_v_dependent_tables_lock', None)
+        super()._afterFork()
+
+    def _queryDependentTables(self, schemas):
+        """ Query the foreign key graph of the given schemas """
 
-                for c in table.c:
-                    fk = c.foreign_key
-                    if fk is not None:
+        def qualified(schema, tablename):
+            if schema == schemas[0]:
+                return tablename
+            return '%s.%s' % (schema, tablename)
+
+        d = {}
+        with self.engine.connect() as connection:
+            rs = connection.execute(DEPENDENT_TABLES_SQL,
+                                    {'schemas': list(schemas)})
+            for row in rs:
+                ref_by_table_name = qualified(row.referenced_schema,
+                                              row.referenced_table)
+                tablename = qualified(row.referencing_schema,
+                                      row.referencing_table)
+                referencing = d.setdefault(ref_by_table_name, [])
+                if tablename not in referencing:
+                    referencing.append(tablename)
+        return d
+
+    def copyFrom(self, name, source, columns=None, format='csv',
+                 buffer_size=65536):
+        """ Load data into the table of the mapper 'name' using
+            COPY ... FROM STDIN on the connection of the current session.
+            'source' is either a file-like object providing data in the
+            given 'format' or an iterable of row sequences (encoded as CSV
+            on the fly). Data is sent in chunks of 'buffer_size' bytes.
+            'columns' is an optional sequence of column names.
+        """
 
-                        ref_by_table = fk.column.table
-                        ref_by_table_name = ref_by_table.name
+        table = self._getTable(name)
+        if not hasattr(source, 'read'):
+            source = RowReader(source)
+            format = 'csv'
+        format = _copyFormat(format)
 
-                        if ref_by_table_name not in d:
-                            d[ref_by_table_name] = list()
+        sql = 'COPY %s%s FROM STDIN WITH (FORMAT %s)' % (
+            self._quoteTable(table), self._quoteColumns(columns), format)
 
-                        if tablename not in d[ref_by_table_name]:
-                            d[ref_by_table_name].append(tablename)
+        cursor = self.connection.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                cursor.copy_expert(sql, source, size=buffer_size)
+            else:
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    while True:
+                        data = source.read(buffer_size)
+                        if not data:
+                            break
+                        copy.write(data)
+        finally:
+            cursor.close()
+        markDirty(self.session, [table.fullname])
+        mark_changed(self.session)
 
-            _cache.ref_mapping = d
+    def copyTo(self, name, file, query=None, columns=None, format='csv',
+               buffer_size=65536):
+        """ Write the content of the table of the mapper 'name' (or the
+            result of 'query', a SQL string or a SQLAlchemy selectable) to
+            'file' using COPY ... TO STDOUT. Data is written in chunks.
+        """
+
+        format = _copyFormat(format)
+        if query is None:
+            source = '%s%s' % (self._quoteTable(self._getTable(name)),
+                               self._quoteColumns(columns))
+        else:
+            if not isinstance(query, str):
+                query = str(query.compile(
+                    dialect=self.engine.dialect,
+                    compile_kwargs={'literal_binds': True}))
+            source = '(%s)' % query
+
+        sql = 'COPY %s TO STDOUT WITH (FORMAT %s)' % (source, format)
+
+        cursor = self.connection.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                cursor.copy_expert(sql, file, size=buffer_size)
+            else:
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    for data in copy:
+                        file.write(data)
+        finally:
+            cursor.close()
+
+    def _quoteTable(self, table):
+        return self.engine.dialect.identifier_preparer.format_table(table)
+
+    def _quoteColumns(self, columns):
+        if not columns:
+            return ''
+        quote = self.engine.dialect.identifier_preparer.quote
+        return ' (%s)' % ', '.join([quote(column) for column in columns])
+
+    def _schemaFingerprint(self, connection, schema=None):
+        """ Return a checksum over the columns and constraints of all
+            tables and views of 'schema' (one catalog query).
+        """
 
-        return _cache.ref_mapping
+        sql = sqlalchemy.text(
+            "SELECT"
+            " (SELECT md5(string_agg(c.relname || ':' || a.attname || ':' ||"
+            "   format_type(a.atttypid, a.atttypmod) || ':' ||"
+            "   a.attnotnull::text, ',' ORDER BY c.relname, a.attnum))"
+            "  FROM pg_attribute a"
+            "  JOIN pg_class c ON c.oid = a.attrelid"
+            "  JOIN pg_namespace n ON n.oid = c.relnamespace"
+            "  WHERE n.nspname = coalesce(:schema, current_schema())"
+            "  AND c.relkind IN ('r', 'v', 'm', 'p', 'f')"
+            "  AND a.attnum > 0 AND NOT a.attisdropped),"
+            " (SELECT md5(string_agg(c.relname || ':' || con.conname || ':' ||"
+            "   pg_get_constraintdef(con.oid), ',' ORDER BY c.relname,"
+            "   con.conname))"
+            "  FROM pg_constraint con"
+            "  JOIN pg_class c ON c.oid = con.conrelid"
+            "  JOIN pg_namespace n ON n.oid = c.relnamespace"
+            "  WHERE n.nspname = coalesce(:schema, current_schema()))")
+        columns, constraints = connection.execute(
+            sql, {'schema': schema}).one()
+        return '%s:%s' % (columns, constraints)
 
 
-class ZopePostgresWrapper(ZopeWrapper, PostgresMixin):
+class ZopePostgresWrapper(PostgresMixin, ZopeWrapper):
     """ A wrapper to be used from within Zope. It connects
         the session with the transaction management of Zope.
     """
@@ -0,0 +1,141 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+SQL profiles of (Zope) transactions
+"""
+
+import logging
+import time
+from collections import Counter
+
+from sqlalchemy import event
+
+from z3c.sqlalchemy.stats import fingerprint
+
+
+LOG = logging.getLogger('z3c.sqlalchemy.profile')
+
+# key within Session.info and Connection.info
+PROFILE_KEY = 'z3c.sqlalchemy.profile'
+
+
+class TransactionProfile:
+    """ Statements executed within a single transaction """
+
+    def __init__(self):
+        self.statements = 0
+        self.time = 0.0
+        self.fingerprints = Counter()
+        self.lazy_loads = Counter()
+        self.connections = []
+
+    def summary(self, nplusone_threshold):
+        """ return the profile as a dict. Relationships lazy loaded at
+            least 'nplusone_threshold' times are reported as likely
+            N+1 patterns.
+        """
+
+        repeated = dict([(fp, count)
+                         for fp, count in self.fingerprints.most_common()
+                         if count > 1])
+        nplusone = [{'mapper': mapper, 'relationship': key, 'count': count}
+                    for (mapper, key), count in self.lazy_loads.most_common()
+                    if count >= nplusone_threshold]
+        return {'statements': self.statements,
+                'time': self.time,
+                'repeated': repeated,
+                'nplusone': nplusone}
+
+
+def logProfile(summary):
+    """ default hook: log transactions with likely N+1 patterns """
+
+    if summary['nplusone']:
+        LOG.warning('%d statements (%.3fs), likely N+1 selects: %s',
+                    summary['statements'], summary['time'],
+                    ', '.join(['%(mapper)s.%(relationship)s (%(count)d)' % n
+                               for n in summary['nplusone']]))
+    else:
+        LOG.debug('%d statements (%.3fs)',
+                  summary['statements'], summary['time'])
+
+
+class TransactionProfiler:
+    """ Collects a TransactionProfile for every transaction of a session.
+        zope.sqlalchemy joins a session with the Zope transaction when the
+        session begins, and commits or rolls back the session when the
+        Zope transaction finishes. The profile therefore starts with
+        the 'after_begin' and ends with the 'after_transaction_end' event
+        of the session. 'hook' is called with the summary of each profile.
+    """
+
+    def __init__(self, hook=None, nplusone_threshold=10):
+        self.hook = hook or logProfile
+        self.nplusone_threshold = nplusone_threshold
+
+    def attach(self, engine, sessionmaker):
+        """ register the event listeners with 'engine' and 'sessionmaker' """
+
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        event.listen(sessionmaker, 'after_begin', self._afterBegin)
+        event.listen(sessionmaker, 'do_orm_execute', self._ormExecute)
+        event.listen(sessionmaker, 'after_transaction_end',
+                     self._afterTransactionEnd)
+
+    def attachEngine(self, engine):
+        """ profile statements of an additional engine (e.g. a replica) """
+
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _afterBegin(self, session, transaction, connection):
+        profile = session.info.get(PROFILE_KEY)
+        if profile is None:
+            profile = session.info[PROFILE_KEY] = TransactionProfile()
+        connection.info[PROFILE_KEY] = profile
+        profile.connections.append(connection.info)
+
+    def _afterTransactionEnd(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        profile = session.info.pop(PROFILE_KEY, None)
+        if profile is None:
+            return
+        for info in profile.connections:
+            info.pop(PROFILE_KEY, None)
+        try:
+            self.hook(profile.summary(self.nplusone_threshold))
+        except Exception:
+            # the transaction is over, a failing hook must not change
+            # its outcome
+            LOG.exception('Transaction profile hook %r failed', self.hook)
+
+    def _ormExecute(self, orm_execute_state):
+        if orm_execute_state.lazy_loaded_from is None:
+            return
+        profile = orm_execute_state.session.info.get(PROFILE_KEY)
+        path = orm_execute_state.loader_strategy_path
+        if profile is not None and path is not None:
+            mapper, prop = path.path[-2:]
+            profile.lazy_loads[(mapper.class_.__name__, prop.key)] += 1
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if PROFILE_KEY in conn.info:
+            context._z3c_profile_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        profile = conn.info.get(PROFILE_KEY)
+        start = getattr(context, '_z3c_profile_start', None)
+        if profile is None or start is None:
+            return
+        profile.statements += 1
+        profile.time += time.perf_counter() - start
+        profile.fingerprints[fingerprint(statement)] += 1
@@ -0,0 +1,135 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Process-wide snapshots of reference data tables
+"""
+
+import threading
+import time
+
+from sqlalchemy import select
+from sqlalchemy.orm import class_mapper
+
+
+class ReferenceData:
+    """ An immutable snapshot of all rows of a table indexed by primary key
+        and by the columns given as 'indexes'. Snapshots are never modified
+        once created and can be shared by all threads without locking.
+    """
+
+    def __init__(self, table, rows, indexes=()):
+        self.table = table
+        self.rows = tuple(rows)
+        self.loaded = time.time()
+
+        pk = [col.key for col in table.primary_key.columns]
+        by_pk = {}
+        for row in self.rows:
+            mapping = row._mapping
+            if len(pk) == 1:
+                by_pk[mapping[pk[0]]] = row
+            else:
+                by_pk[tuple([mapping[key] for key in pk])] = row
+        self._pk = by_pk
+
+        self._indexes = {}
+        for column in indexes:
+            index = {}
+            for row in self.rows:
+                index.setdefault(row._mapping[column], []).append(row)
+            self._indexes[column] = dict([(value, tuple(rows))
+                                          for value, rows in index.items()])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def get(self, pk, default=None):
+        """ return the row with the primary key 'pk' (a tuple for
+            composite primary keys)
+        """
+        return self._pk.get(pk, default)
+
+    def lookup(self, column, value):
+        """ return a tuple of all rows where 'column' (one of the indexed
+            columns) equals 'value'
+        """
+
+        try:
+            index = self._indexes[column]
+        except KeyError:
+            raise KeyError('Column %r of %s is not indexed' %
+                           (column, self.table.fullname))
+        return index.get(value, ())
+
+
+class ReferenceDataCollection:
+    """ Loads the reference data tables of a wrapper once per process.
+        Snapshots older than 'reload_interval' seconds are reloaded by the
+        first thread noticing it while the other threads continue to use
+        the current snapshot.
+    """
+
+    def __init__(self, wrapper, reload_interval=None):
+        self._wrapper = wrapper
+        self.reload_interval = reload_interval
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """ return the snapshot of the reference data table 'name' """
+
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshots.get(name)
+                if snapshot is None:
+                    snapshot = self._load(name)
+        elif self.reload_interval is not None and \
+                time.time() - snapshot.loaded > self.reload_interval:
+            # only one thread reloads, the others use the current snapshot
+            if self._lock.acquire(blocking=False):
+                try:
+                    snapshot = self._load(name)
+                finally:
+                    self._lock.release()
+        return snapshot
+
+    def reload(self, name=None):
+        """ reload the snapshot of 'name' or of all loaded tables """
+
+        with self._lock:
+            names = [name]
+            if name is None:
+                names = list(self._snapshots)
+            for name in names:
+                self._load(name)
+
+    def _load(self, name):
+        entry = (self._wrapper.model or {}).get(name) or {}
+        reference = entry.get('reference')
+        if reference is None or reference is False:
+            raise ValueError('%s is not marked as reference data' % name)
+
+        indexes = ()
+        if reference is not True:
+            indexes = tuple(reference)
+
+        table = class_mapper(self._wrapper.getMapper(name)).local_table
+        with self._wrapper.engine.connect() as connection:
+            rows = connection.execute(select(table)).all()
+
+        # the snapshot is replaced atomically
+        snapshot = self._snapshots[name] = ReferenceData(table, rows, indexes)
+        return snapshot
@@ -0,0 +1,221 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Persistent cache for reflected table definitions
+"""
+
+import atexit
+import hashlib
+import logging
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import weakref
+
+import sqlalchemy
+from sqlalchemy import MetaData
+
+
+LOG = logging.getLogger('z3c.sqlalchemy')
+
+CACHE_VERSION = 1
+
+# caches with unsaved tables, flushed on exit
+_pending = weakref.WeakSet()
+
+
+class ReflectionCache:
+    """ A file based cache for table definitions obtained through
+        reflection. The cache file is keyed by the DSN of the wrapper.
+        Inside the file all tables are grouped by schema and every schema
+        carries a fingerprint of its definition at the time the tables
+        were reflected. Tables of a schema are only taken from the cache
+        as long as the fingerprint of the live schema still matches.
+
+        The cache files are pickles, loading them can execute arbitrary
+        code: the cache directory must only be writable by trusted users.
+        Cache files owned by another user or writable by group or others
+        are ignored.
+
+        Freshly reflected tables are written in batches: scheduleSave()
+        writes the cache file 'save_delay' seconds after the first unsaved
+        table has been added, flush() writes it immediately.
+    """
+
+    # seconds between the first unsaved table and writing the cache file
+    save_delay = 1.0
+
+    def __init__(self, directory, url, fingerprint):
+        """ 'directory' - directory holding the cache files
+
+            'url' - sqlalchemy.engine.url.URL of the database
+
+            'fingerprint' - callable(connection, schema) returning a string
+            identifying the current state of a schema
+        """
+
+        # pickles of other SQLAlchemy versions might not be loadable
+        key = '%s %s %s' % (url.render_as_string(hide_password=True),
+                            CACHE_VERSION, sqlalchemy.__version__)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.filename = os.path.join(directory, '%s.reflection' % digest)
+        self._fingerprint = fingerprint
+        self._fingerprints = {}
+        self._metadata = MetaData()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+        self._engine = None
+
+    def load(self, engine, metadata):
+        """ Copy all cached tables of unchanged schemas into 'metadata'.
+            Tables already defined within 'metadata' are left untouched.
+            Returns the list of keys of the tables taken from the cache.
+        """
+
+        data = self._read()
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            return []
+
+        loaded = []
+        with self._lock, engine.connect() as connection:
+            for schema, entry in data['schemas'].items():
+                fingerprint = self._fingerprint(connection, schema)
+                if fingerprint != entry['fingerprint']:
+                    # schema changed since the tables were cached
+                    continue
+
+                self._fingerprints[schema] = fingerprint
+                for table in entry['tables'].tables.values():
+                    table.to_metadata(self._metadata)
+                    if table.key not in metadata.tables:
+                        table.to_metadata(metadata)
+                        loaded.append(table.key)
+        return loaded
+
+    def _read(self):
+        """ return the unpickled content of the cache file or None """
+
+        try:
+            with open(self.filename, 'rb') as fp:
+                info = os.fstat(fp.fileno())
+                if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH) or \
+                        hasattr(os, 'getuid') and \
+                        info.st_uid not in (os.getuid(), 0):
+                    LOG.warning('Ignoring the reflection cache %s, it is '
+                                'writable by other users', self.filename)
+                    return None
+                return pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # truncated or foreign files, pickles of other versions
+            LOG.warning('Ignoring the unreadable reflection cache %s',
+                        self.filename, exc_info=True)
+            return None
+
+    def _afterFork(self):
+        # called in a forked child process: the timer thread of a
+        # scheduled write does not exist there
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, table):
+        """ Remember a freshly reflected table """
+
+        with self._lock:
+            if table.key not in self._metadata.tables:
+                table.to_metadata(self._metadata)
+                self._dirty = True
+
+    def scheduleSave(self, engine):
+        """ Write the remembered tables 'save_delay' seconds from now
+            (unless a write is already scheduled)
+        """
+
+        with self._lock:
+            self._engine = engine
+            if not self._dirty or self._timer is not None:
+                return
+            _pending.add(self)
+            self._timer = threading.Timer(self.save_delay, self._save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self, engine=None):
+        """ Write the remembered tables now if some have not been
+            written yet
+        """
+
+        with self._lock:
+            if engine is not None:
+                self._engine = engine
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty or self._engine is None:
+                return
+        self.save(self._engine)
+
+    def _save(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            LOG.exception('Writing the reflection cache %s failed',
+                          self.filename)
+
+    def save(self, engine):
+        """ Write all remembered tables to the cache file """
+
+        with self._lock:
+            self._dirty = False
+            _pending.discard(self)
+            schemas = {}
+            for table in self._metadata.tables.values():
+                schemas.setdefault(table.schema, []).append(table)
+
+            data = {'version': CACHE_VERSION, 'schemas': {}}
+            with engine.connect() as connection:
+                for schema, tables in schemas.items():
+                    if schema not in self._fingerprints:
+                        self._fingerprints[schema] = self._fingerprint(
+                            connection, schema)
+
+                    metadata = MetaData()
+                    for table in tables:
+                        table.to_metadata(metadata)
+                    data['schemas'][schema] = {
+                        'fingerprint': self._fingerprints[schema],
+                        'tables': metadata,
+                    }
+
+            # write to a temporary file first in order to replace the
+            # cache file atomically (other processes might read it)
+            directory = os.path.dirname(self.filename)
+            fd, tmpname = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpname, self.filename)
+            except BaseException:
+                os.remove(tmpname)
+                raise
+
+
+@atexit.register
+def _flushPending():
+    for cache in list(_pending):
+        try:
+            cache.flush()
+        except Exception:
+            LOG.exception('Writing the reflection cache %s failed',
+                          cache.filename)
@@ -0,0 +1,146 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Routing of read-only statements to replica databases
+"""
+
+import itertools
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.orm import Session
+
+
+STRATEGIES = ('round-robin', 'least-connections')
+
+# key within Session.info marking a session transaction that wrote data
+WRITE_KEY = 'z3c.sqlalchemy.write'
+
+
+class ReplicaSet:
+    """ A set of read-only replica engines. Replicas failing to connect
+        (or being disconnected) are taken out of rotation for
+        'retry_interval' seconds.
+    """
+
+    def __init__(self, engines, strategy='round-robin', retry_interval=30):
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown replica strategy %r (use one of %s)' %
+                             (strategy, ', '.join(STRATEGIES)))
+        self.engines = list(engines)
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        self._down = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._handleError)
+
+    def choose(self):
+        """ return a healthy replica engine or None if all replicas
+            are down
+        """
+
+        now = time.monotonic()
+        down = self._down
+        healthy = [engine for engine in self.engines
+                   if now - down.get(engine, -self.retry_interval) >=
+                   self.retry_interval]
+        if not healthy:
+            return None
+
+        if self.strategy == 'least-connections':
+            return min(healthy, key=_checkedout)
+        return healthy[next(self._counter) % len(healthy)]
+
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
+
+    def markDown(self, engine):
+        with self._lock:
+            self._down[engine] = time.monotonic()
+
+    def markUp(self, engine):
+        with self._lock:
+            self._down.pop(engine, None)
+
+    def checkHealth(self):
+        """ probe all replicas and return a mapping URL -> healthy """
+
+        result = {}
+        for engine in self.engines:
+            try:
+                with engine.connect() as connection:
+                    connection.exec_driver_sql('SELECT 1')
+            except exc.DBAPIError:
+                self.markDown(engine)
+                healthy = False
+            else:
+                self.markUp(engine)
+                healthy = True
+            result[engine.url.render_as_string(hide_password=True)] = healthy
+        return result
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def _handleError(self, context):
+        # connect failures (no connection yet) and disconnects
+        if context.connection is None or context.is_disconnect:
+            self.markDown(context.engine)
+
+
+def _checkedout(engine):
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout is not None and checkedout() or 0
+
+
+class RoutingSession(Session):
+    """ A session sending read-only statements to a replica and everything
+        else (and all statements following the first write within a
+        transaction) to the primary database. The connection to the chosen
+        replica is established before the statement is bound to it; if that
+        fails the replica is taken out of rotation and the next healthy
+        replica (finally the primary database) is tried.
+    """
+
+    def __init__(self, replicas=None, **kw):
+        super().__init__(**kw)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.replicas is not None and \
+                not self.info.get(WRITE_KEY) and \
+                not self._flushing and \
+                getattr(clause, 'is_select', False) and \
+                getattr(clause, '_for_update_arg', None) is None:
+            engine = self.replicas.choose()
+            while engine is not None:
+                try:
+                    # the connection is kept by the session transaction
+                    self.connection(bind_arguments={'bind': engine})
+                except (exc.DBAPIError, exc.TimeoutError):
+                    self.replicas.markDown(engine)
+                    engine = self.replicas.choose()
+                else:
+                    return engine
+        elif self.replicas is not None:
+            # anything else is considered a write
+            self.info[WRITE_KEY] = True
+
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _resetWriteFlag(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(WRITE_KEY, None)
@@ -0,0 +1,220 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Horizontal sharding across multiple databases
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+from zope.interface import implementer
+from zope.sqlalchemy import register
+
+from z3c.sqlalchemy.base import ZopeWrapper
+from z3c.sqlalchemy.interfaces import ISQLAlchemyWrapper
+from z3c.sqlalchemy.mapper import Proxy
+from z3c.sqlalchemy.stats import PoolStatistics
+from z3c.sqlalchemy.stats import mergePoolStats
+
+
+@implementer(ISQLAlchemyWrapper)
+class ShardedZopeWrapper(ZopeWrapper):
+    """ A wrapper for one logical database partitioned across multiple
+        databases with identical schemas. All shards share the model and
+        the mappers (tables are reflected through 'default_shard'). The
+        session (a ShardedSession of SQLAlchemy) spans all shards and
+        joins the Zope transaction once, so all shards are committed or
+        aborted together (pass twophase=True for two-phase commits).
+
+        bulkInsert() and bulkUpsert() insert every row into the shard
+        returned by 'shard_chooser' for a (transient) instance of the mapper
+        holding the values of the row. Reference data is not supported.
+    """
+
+    _v_shards = None
+
+    def __init__(self, shards, shard_chooser, model=None, default_shard=None,
+                 identity_chooser=None, execute_chooser=None, **kw):
+        """ 'shards' - a dict mapping shard ids to DSNs
+
+            'shard_chooser' - a callable (mapper, instance, clause=None)
+            returning the shard id for storing 'instance'
+
+            'default_shard' - the id of the shard used for reflection and
+            for wrapper.engine (default: the first shard)
+
+            'identity_chooser' - optional callable (mapper, primary_key,
+            **kw) returning the ids of the shards possibly holding the
+            object with 'primary_key' (default: all shards)
+
+            'execute_chooser' - optional callable (orm_execute_state)
+            returning the ids of the shards a query is executed on
+            (default: all shards)
+
+            All other parameters are passed to ZopeWrapper.
+        """
+
+        if kw.get('replicas'):
+            raise ValueError("'replicas' is not supported by "
+                             "ShardedZopeWrapper")
+        if not shards:
+            raise ValueError('At least one shard is required')
+
+        self.shards = dict(shards)
+        if default_shard is None:
+            default_shard = next(iter(self.shards))
+        self.default_shard = default_shard
+        self.shard_chooser = shard_chooser
+        self.identity_chooser = identity_chooser or self._allShards
+        self.execute_chooser = execute_chooser or self._allShards
+        super().__init__(self.shards[default_shard], model, **kw)
+
+    @property
+    def connection(self):
+        """ Return the underlying connection to the default shard """
+        return self.session.connection(
+            bind_arguments={'shard_id': self.default_shard}).connection
+
+    @property
+    def engines(self):
+        """ mapping shard id -> engine """
+        return dict(self._shards)
+
+    def fanout(self, statement, shards=None, key=None, as_dict=False):
+        """ Execute a SELECT statement on all (or the given) shards in
+            parallel and return the merged results, optionally sorted by
+            'key'. Every shard is queried through a connection of its own
+            outside of the current transaction (uncommitted changes of the
+            session are not visible). Queries for mapped objects return
+            detached objects, all other queries rows (or dicts with
+            as_dict=True).
+        """
+
+        if shards is None:
+            shards = self._shards
+        shards = list(shards)
+        if not shards:
+            return []
+        entity = self._resultEntity(statement)
+
+        def query(shard_id):
+            with Session(bind=self._shards[shard_id]) as session:
+                result = session.execute(statement)
+                if entity is not None:
+                    return result.scalars().all()
+                return result.all()
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            results = list(executor.map(query, shards))
+
+        merged = [row for result in results for row in result]
+        if key is not None:
+            merged.sort(key=key)
+        if as_dict:
+            if entity is not None:
+                return [Proxy(obj) for obj in merged]
+            return [dict(row._mapping) for row in merged]
+        return merged
+
+    @property
+    def _shards(self):
+        if self._v_sessionmaker is None:
+            self._initEngine()
+        return self._v_shards
+
+    @_shards.setter
+    def _shards(self, shards):
+        self._v_shards = shards
+
+    def poolStats(self):
+        """ Return the aggregated statistics of the pools of all shards """
+        return mergePoolStats(self.shardPoolStats().values())
+
+    def shardPoolStats(self):
+        """ Return the pool statistics per shard id """
+        if self._v_sessionmaker is None:
+            # the engines have not been created yet
+            return {}
+        return dict([(shard_id, self._shard_pool_stats[shard_id].snapshot(
+                      engine.pool))
+                     for shard_id, engine in self._shards.items()])
+
+    def getReferenceData(self, name):
+        raise NotImplementedError('getReferenceData() is not supported by '
+                                  'ShardedZopeWrapper')
+
+    def reloadReferenceData(self, name=None):
+        raise NotImplementedError('reloadReferenceData() is not supported '
+                                  'by ShardedZopeWrapper')
+
+    def _partitionRows(self, name, chunk):
+        mapper = inspect(self.getMapper(name))
+        partitions = {}
+        for row in chunk:
+            instance = mapper.class_manager.new_instance()
+            for key, value in row.items():
+                setattr(instance, key, value)
+            shard_id = self.shard_chooser(mapper, instance)
+            partitions.setdefault(shard_id, []).append(row)
+        return [({'shard_id': shard_id}, rows)
+                for shard_id, rows in partitions.items()]
+
+    def _allShards(self, *args, **kw):
+        return list(self._shards)
+
+    def _allEngines(self):
+        return list(self._v_shards.values())
+
+    def _afterFork(self):
+        super()._afterFork()
+        if self._v_sessionmaker is not None:
+            for pool_stats in self._shard_pool_stats.values():
+                if pool_stats is not self._pool_stats:
+                    pool_stats._afterFork()
+
+    def _createEngine(self):
+        shards = self._shards = {}
+        self._shard_pool_stats = {}
+        for shard_id, dsn in self.shards.items():
+            engine = create_engine(dsn, **self.engine_options)
+            pool_stats = PoolStatistics()
+            pool_stats.attach(engine)
+            if self._query_stats is not None:
+                self._query_stats.attach(engine)
+            if self._circuit is not None:
+                self._circuit.attach(engine)
+            shards[shard_id] = engine
+            self._shard_pool_stats[shard_id] = pool_stats
+
+        self._engine = shards[self.default_shard]
+        self._pool_stats = self._shard_pool_stats[self.default_shard]
+        self._replicas = None
+
+        self._sessionmaker = scoped_session(sessionmaker(
+            class_=ShardedSession,
+            shards=shards,
+            shard_chooser=self.shard_chooser,
+            identity_chooser=self.identity_chooser,
+            execute_chooser=self.execute_chooser,
+            twophase=self.twophase,
+            autoflush=True,
+            **self.session_options))
+        session_factory = self._sessionmaker.session_factory
+        if self._result_cache is not None:
+            self._result_cache.attach(session_factory)
+        if self._profiler is not None:
+            self._profiler.attach(self._engine, session_factory)
+            for engine in shards.values():
+                if engine is not self._engine:
+                    self._profiler.attachEngine(engine)
+        register(self._sessionmaker, **self.extension_options)
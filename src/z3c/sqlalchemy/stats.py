@@ -0,0 +1,327 @@
+##########################################################################
+# z3c.sqlalchemy - A SQLAlchemy wrapper for Python/Zope
+#
+# (C) Zope Corporation and Contributor
+# Written by Andreas Jung for Haufe Mediengruppe, Freiburg, Germany
+# and ZOPYX Ltd. & Co. KG, Tuebingen, Germany
+##########################################################################
+"""
+Connection pool and query statistics
+"""
+
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
+
+from sqlalchemy import event
+
+
+SLOW_QUERY_LOG = logging.getLogger('z3c.sqlalchemy.slowquery')
+
+
+# upper bounds (in seconds) of the buckets of the checkout wait histogram,
+# the last bucket (None) collects everything above
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, None)
+
+COUNTERS = ('connects', 'checkouts', 'checkins', 'checkout_errors',
+            'invalidations', 'soft_invalidations')
+
+
+class PoolStatistics:
+    """ Collects statistics about the connection pool of an engine through
+        pool events. The time spent waiting for a connection is measured
+        around Pool.connect() which covers waiting for a pooled connection
+        as well as opening a new one (for all engines sharing the pool,
+        e.g. those returned by Engine.execution_options()).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._histogram = [0] * len(WAIT_BUCKETS)
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._created = {}
+
+    def attach(self, engine):
+        """ register the event listeners with 'engine' """
+
+        event.listen(engine, 'connect', self._connect)
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'checkin', self._checkin)
+        event.listen(engine, 'close', self._close)
+        event.listen(engine, 'invalidate', self._invalidate)
+        event.listen(engine, 'soft_invalidate', self._softInvalidate)
+        # Engine.dispose() replaces the pool
+        event.listen(engine, 'engine_disposed', self._timePool)
+        self._timePool(engine)
+
+    def _timePool(self, engine):
+        pool = engine.pool
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                connection = connect()
+            except Exception:
+                self._count('checkout_errors')
+                raise
+            self._recordWait(time.perf_counter() - start)
+            return connection
+
+        pool.connect = timed_connect
+
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
+
+    def snapshot(self, pool):
+        """ return the current statistics as a dict """
+
+        now = time.time()
+        with self._lock:
+            stats = dict(self._counters)
+            ages = [now - created for created in self._created.values()]
+            histogram = list(self._histogram)
+            wait_total = self._wait_total
+            wait_max = self._wait_max
+
+        for name in ('size', 'checkedout', 'overflow'):
+            # not all pool implementations provide these methods
+            # (SingletonThreadPool.size is an int)
+            method = getattr(pool, name, None)
+            stats[name] = callable(method) and method() or 0
+        # QueuePool.overflow() is negative as long as the pool has not
+        # been filled up to its size, report the overflow connections only
+        stats['overflow'] = max(stats['overflow'], 0)
+
+        stats['wait'] = {
+            'count': sum(histogram),
+            'total': wait_total,
+            'max': wait_max,
+            'histogram': list(zip(WAIT_BUCKETS, histogram)),
+        }
+        stats['age'] = {
+            'count': len(ages),
+            'min': ages and min(ages) or 0.0,
+            'max': ages and max(ages) or 0.0,
+            'avg': ages and sum(ages) / len(ages) or 0.0,
+        }
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _recordWait(self, duration):
+        for index, bound in enumerate(WAIT_BUCKETS):
+            if bound is None or duration <= bound:
+                break
+        with self._lock:
+            self._histogram[index] += 1
+            self._wait_total += duration
+            if duration > self._wait_max:
+                self._wait_max = duration
+
+    def _connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._counters['connects'] += 1
+            self._created[id(dbapi_connection)] = time.time()
+
+    def _checkout(self, dbapi_connection, connection_record,
+                  connection_proxy):
+        self._count('checkouts')
+
+    def _checkin(self, dbapi_connection, connection_record):
+        self._count('checkins')
+
+    def _close(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._created.pop(id(dbapi_connection), None)
+
+    def _invalidate(self, dbapi_connection, connection_record, exception):
+        self._count('invalidations')
+
+    def _softInvalidate(self, dbapi_connection, connection_record,
+                        exception):
+        self._count('soft_invalidations')
+
+
+def poolSize(pool):
+    """ return the number of connections kept by 'pool' or None if the
+        pool does not limit them
+    """
+
+    size = getattr(pool, 'size', None)
+    if callable(size):
+        # QueuePool
+        return size()
+    if isinstance(size, int):
+        # SingletonThreadPool (one connection per thread)
+        return size
+    return None
+
+
+def mergePoolStats(stats):
+    """ aggregate a sequence of statistics returned by
+        PoolStatistics.snapshot()
+    """
+
+    stats = list(stats)
+    total = dict.fromkeys(COUNTERS + ('size', 'checkedout', 'overflow'), 0)
+    wait = {'count': 0, 'total': 0.0, 'max': 0.0,
+            'histogram': [[bound, 0] for bound in WAIT_BUCKETS]}
+    age = {'count': 0, 'min': 0.0, 'max': 0.0, 'avg': 0.0}
+
+    age_total = 0.0
+    for s in stats:
+        for name in total:
+            total[name] += s[name]
+
+        wait['count'] += s['wait']['count']
+        wait['total'] += s['wait']['total']
+        wait['max'] = max(wait['max'], s['wait']['max'])
+        for bucket, (bound, count) in zip(wait['histogram'],
+                                          s['wait']['histogram']):
+            bucket[1] += count
+
+        if s['age']['count']:
+            if age['count']:
+                age['min'] = min(age['min'], s['age']['min'])
+            else:
+                age['min'] = s['age']['min']
+            age['max'] = max(age['max'], s['age']['max'])
+            age['count'] += s['age']['count']
+            age_total += s['age']['avg'] * s['age']['count']
+
+    if age['count']:
+        age['avg'] = age_total / age['count']
+    wait['histogram'] = [tuple(bucket) for bucket in wait['histogram']]
+    total['wait'] = wait
+    total['age'] = age
+    return total
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)'
+_INLISTS = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)' %
+                      (_PLACEHOLDER, _PLACEHOLDER))
+_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """ normalize a SQL statement: literals are replaced by '?', lists of
+        placeholders by '(...)' and whitespace is collapsed.
+    """
+
+    statement = _LITERALS.sub('?', statement)
+    statement = _INLISTS.sub('(...)', statement)
+    return _SPACES.sub(' ', statement).strip()
+
+
+def _percentile(values, percent):
+    """ nearest-rank percentile of a sorted list """
+    index = max(0, math.ceil(percent / 100.0 * len(values)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class QueryStatistics:
+    """ Records the execution time of all statements executed through an
+        engine per statement fingerprint. The number of fingerprints is
+        bounded by 'max_statements' (least recently executed ones are
+        dropped), percentiles are computed over the last 'samples'
+        executions. Statements taking longer than 'slow_query_threshold'
+        seconds are logged to the 'z3c.sqlalchemy.slowquery' logger.
+
+        'rows' is taken from cursor.rowcount right after the execution:
+        the rows affected by INSERT, UPDATE and DELETE statements. Rows
+        returned by SELECT statements are only counted by drivers
+        reporting them through rowcount (e.g. psycopg2, not sqlite3),
+        otherwise they count as 0.
+    """
+
+    def __init__(self, max_statements=1000, samples=1000,
+                 slow_query_threshold=None):
+        self.max_statements = max_statements
+        self.samples = samples
+        self.slow_query_threshold = slow_query_threshold
+        self._lock = threading.Lock()
+        self._statements = OrderedDict()
+
+    def _afterFork(self):
+        # called in a forked child process
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        """ register the event listeners with 'engine' """
+
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def statistics(self, limit=None):
+        """ return a list of dicts (one per fingerprint) sorted by the total
+            execution time
+        """
+
+        with self._lock:
+            entries = [(fp, dict(entry), sorted(entry['samples']))
+                       for fp, entry in self._statements.items()]
+
+        result = []
+        for fp, entry, samples in entries:
+            del entry['samples']
+            entry['statement'] = fp
+            entry['avg'] = entry['total'] / entry['count']
+            entry['p50'] = _percentile(samples, 50)
+            entry['p95'] = _percentile(samples, 95)
+            result.append(entry)
+
+        result.sort(key=lambda entry: entry['total'], reverse=True)
+        return result[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        context._z3c_query_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        start = getattr(context, '_z3c_query_start', None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        rows = cursor.rowcount
+        if rows is None or rows < 0:
+            rows = 0
+        self.record(fingerprint(statement), duration, rows)
+
+        if self.slow_query_threshold is not None and \
+                duration >= self.slow_query_threshold:
+            SLOW_QUERY_LOG.warning('%.3fs: %s -- parameters: %r',
+                                   duration, statement, parameters)
+
+    def record(self, fp, duration, rows=0):
+        with self._lock:
+            entry = self._statements.get(fp)
+            if entry is None:
+                entry = self._statements[fp] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0, 'rows': 0,
+                    'samples': deque(maxlen=self.samples)}
+                if len(self._statements) > self.max_statements:
+                    self._statements.popitem(last=False)
+            else:
+                self._statements.move_to_end(fp)
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['rows'] += rows
+            entry['samples'].append(duration)
+            if duration > entry['max']:
+                entry['max'] = duration
@@ -11,28 +11,45 @@
 Tests, tests, tests.........
 """
 
+import asyncio
+import gc
+import io
 import os
+import shutil
 import tempfile
+import threading
+import time
 import unittest
+import warnings
+import weakref
+from unittest import mock
 
 import sqlalchemy
 import sqlalchemy.orm
+import transaction
 from sqlalchemy import Column
+from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
 from sqlalchemy import MetaData
 from sqlalchemy import String
 from sqlalchemy import Table
+from sqlalchemy import Text
+from sqlalchemy import event
 from sqlalchemy import exc
 from sqlalchemy.orm import declarative_base
 from zope.interface.verify import verifyClass
 
 from z3c.sqlalchemy import Model
+from z3c.sqlalchemy import allSAWrapperPoolStats
 from z3c.sqlalchemy import createSAWrapper
 from z3c.sqlalchemy import getSAWrapper
 from z3c.sqlalchemy import registerSAWrapper
+from z3c.sqlalchemy.interfaces import IAsyncSQLAlchemyWrapper
 from z3c.sqlalchemy.interfaces import IModel
 from z3c.sqlalchemy.interfaces import ISQLAlchemyWrapper
 from z3c.sqlalchemy.mapper import MappedClassBase
+from z3c.sqlalchemy.postgres import RowReader
 from z3c.sqlalchemy.postgres import ZopePostgresWrapper
 
 
@@ -57,9 +74,31 @@ class WrapperTests(unittest.TestCase):
               Column('user_id', Integer, primary_key=True),
               Column('name', String(255)))
 
+        Table('addresses', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('user_id', Integer, ForeignKey('users.id')),
+              Column('email', String(255)))
+
         metadata.create_all(bind=wrapper.engine)
 
+    def _trackReflection(self):
+        """ return a list collecting the names of all reflected tables """
+
+        reflected = []
+        seen = set()
+
+        def column_reflect(inspector, table, column_info):
+            if id(table) not in seen:
+                seen.add(id(table))
+                reflected.append(table.name)
+
+        sqlalchemy.event.listen(Table, 'column_reflect', column_reflect)
+        self.addCleanup(sqlalchemy.event.remove,
+                        Table, 'column_reflect', column_reflect)
+        return reflected
+
     def tearDown(self):
+        transaction.abort()
         if self.tempfile:
             os.remove(self.tempfile)
         else:
@@ -132,6 +171,20 @@ class WrapperTests(unittest.TestCase):
         db.getMapper('skills')
         db.getMappers('users', 'skills')
 
+    def testMapperClassNames(self):
+        # one table mapped under two names within the shared registry
+        M = Model()
+        M.add('users')
+        M.add('people', table_name='users')
+        db = createSAWrapper(self.dsn, model=M)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', exc.SAWarning)
+            User = db.getMapper('users')
+            Person = db.getMapper('people')
+            db.configure()
+        self.assertEqual(User.__name__, '_mapped_users')
+        self.assertEqual(Person.__name__, '_mapped_people')
+
     def testModelWeirdParameters(self):
         M = Model()
         self.assertRaises(ValueError,
@@ -248,3 +301,1441 @@ class WrapperTests(unittest.TestCase):
 
         rows = session.query(Foo).all()
         self.assertEqual(len(rows), 2)
+
+    def testReflectionCache(self):
+        cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cachedir)
+
+        db = createSAWrapper(self.dsn, reflection_cache=cachedir)
+        self.assertNotIn('users', db.metadata.tables)
+        db.reflection_cache.save_delay = 60
+        db.getMapper('users')
+        db.getMapper('addresses')
+        # single tables are written in batches
+        self.assertEqual(os.listdir(cachedir), [])
+        db.reflection_cache.flush()
+        self.assertEqual(len(os.listdir(cachedir)), 1)
+
+        # a new wrapper picks up the table definition from the cache
+        reflected = self._trackReflection()
+        db = createSAWrapper(self.dsn, reflection_cache=cachedir)
+        self.assertIn('users', db.metadata.tables)
+        User = db.getMapper('users')
+        self.assertEqual(reflected, [])
+        self.assertEqual(db.session.query(User).count(), 0)
+
+        # changing the schema invalidates the cache
+        Table('groups', MetaData(),
+              Column('id', Integer, primary_key=True)).create(db.engine)
+        db = createSAWrapper(self.dsn, reflection_cache=cachedir)
+        self.assertNotIn('users', db.metadata.tables)
+        db.getMapper('users')
+        self.assertIn('users', reflected)
+
+        # getMappers() writes the cache at once
+        os.remove(db.reflection_cache.filename)
+        db.getMappers('users', 'addresses')
+        self.assertTrue(os.path.exists(db.reflection_cache.filename))
+        db.reflection_cache.flush()
+
+        # cache files of other users are ignored
+        os.chmod(db.reflection_cache.filename, 0o666)
+        with self.assertLogs('z3c.sqlalchemy', 'WARNING') as log:
+            db = createSAWrapper(self.dsn, reflection_cache=cachedir)
+        self.assertIn('writable by other users', log.output[0])
+        self.assertNotIn('users', db.metadata.tables)
+
+        # unloadable cache files (e.g. pickles of another SQLAlchemy
+        # version) fall back to reflection
+        with open(db.reflection_cache.filename, 'wb') as fp:
+            fp.write(b'cno_such_module\nTable\n.')
+        os.chmod(db.reflection_cache.filename, 0o600)
+        with self.assertLogs('z3c.sqlalchemy', 'WARNING') as log:
+            db = createSAWrapper(self.dsn, reflection_cache=cachedir)
+        self.assertIn('unreadable reflection cache', log.output[0])
+        self.assertNotIn('users', db.metadata.tables)
+        db.getMapper('users')
+        db.reflection_cache.flush()
+
+        # databases without a schema fingerprint are refused
+        self.assertRaises(ValueError, createSAWrapper, 'firebird://host/db',
+                          reflection_cache=cachedir)
+
+    def testGetMappersBatchedReflection(self):
+        M = Model()
+        M.add('users', relations=('addresses',))
+        M.add('addresses')
+        db = createSAWrapper(self.dsn, model=M)
+
+        reflects = []
+        orig_reflect = db.metadata.reflect
+
+        def reflect(**kw):
+            reflects.append(kw['schema'])
+            return orig_reflect(**kw)
+
+        db.metadata.reflect = reflect
+        User, Address = db.getMappers('users', 'addresses')
+        self.assertEqual(reflects, [None])
+        self.assertIn('addresses', db.metadata.tables)
+        self.assertEqual(db.getMapper('addresses'), Address)
+
+    def testPreload(self):
+        M = Model()
+        M.add('users')
+        M.add('skills')
+        db = createSAWrapper(self.dsn, model=M)
+        reflected = self._trackReflection()
+        db.preload()
+        self.assertEqual(sorted(reflected), ['skills', 'users'])
+        self.assertEqual(sorted(db._mappers.keys()), ['skills', 'users'])
+
+    def testConcurrentGetMapper(self):
+        db = createSAWrapper(self.dsn)
+        reflected = self._trackReflection()
+
+        created = []
+        factory = db._mappers._mapper_factory
+
+        def mapper_factory(table, **kw):
+            created.append(table.name)
+            return factory(table, **kw)
+
+        db._mappers._mapper_factory = mapper_factory
+
+        num_threads = 16
+        barrier = threading.Barrier(num_threads)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(db.getMapper('users'))
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), num_threads)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(reflected, ['users'])
+        self.assertEqual(created, ['users'])
+
+    def testFindDependentTablesCached(self):
+        db = ZopePostgresWrapper(self.dsn)
+        calls = []
+
+        def query(schemas):
+            calls.append(schemas)
+            return {'users': ['skills']}
+
+        db._queryDependentTables = query
+        threads = [threading.Thread(target=db.findDependentTables)
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(db.findDependentTables(), {'users': ['skills']})
+        self.assertEqual(calls, [('public',)])
+
+        db.findDependentTables(schema=('public', 'other'))
+        self.assertEqual(calls, [('public',), ('public', 'other')])
+
+        # a slow query of one wrapper does not block other wrappers
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_query(schemas):
+            started.set()
+            release.wait(5)
+            return {}
+
+        slow = ZopePostgresWrapper(self.dsn)
+        slow._queryDependentTables = slow_query
+        thread = threading.Thread(target=slow.findDependentTables)
+        thread.start()
+        started.wait(5)
+        try:
+            other = ZopePostgresWrapper(self.dsn)
+            other._queryDependentTables = query
+            self.assertEqual(other.findDependentTables(),
+                             {'users': ['skills']})
+            self.assertTrue(thread.is_alive())
+        finally:
+            release.set()
+            thread.join()
+
+    def testFindDependentTablesIgnoreErrors(self):
+        if self.tempfile is None:
+            return
+        # the catalog query fails for non-Postgres databases
+        db = ZopePostgresWrapper(self.dsn)
+        with self.assertLogs('z3c.sqlalchemy', 'WARNING') as log:
+            self.assertEqual(db.findDependentTables(ignoreErrors=True), {})
+        self.assertIn("Can't introspect dependent tables of public",
+                      log.output[0])
+        self.assertRaises(exc.DBAPIError, db.findDependentTables)
+
+    def testSharedRegistryAndConfigure(self):
+        M = Model()
+        M.add('users', relations=('addresses',))
+        M.add('addresses')
+        db = createSAWrapper(self.dsn, model=M)
+        User, Address = db.getMappers('users', 'addresses')
+        self.assertIs(sqlalchemy.inspect(User).registry, db.registry)
+        self.assertIs(sqlalchemy.inspect(Address).registry, db.registry)
+        self.assertFalse(sqlalchemy.inspect(User).configured)
+
+        duration = db.configure()
+        self.assertGreaterEqual(duration, 0.0)
+        self.assertTrue(sqlalchemy.inspect(User).configured)
+        self.assertIn('addresses', sqlalchemy.inspect(User).relationships)
+
+    def testAsDict(self):
+
+        class myUser(MappedClassBase):
+            proxied_properties = ('fullname',)
+
+            @property
+            def fullname(self):
+                return '%s %s' % (self.firstname, self.lastname)
+
+        M = Model()
+        M.add('users', mapper_class=myUser)
+        db = createSAWrapper(self.dsn, model=M)
+        User = db.getMapper('users')
+        session = db.session
+        session.add(User(id=1, firstname='udo', lastname='juergens'))
+        session.flush()
+
+        d = session.query(User).one().asDict()
+        self.assertEqual(d, {'id': 1,
+                             'firstname': 'udo',
+                             'lastname': 'juergens',
+                             'fullname': 'udo juergens'})
+        self.assertEqual(d.firstname, 'udo')
+        self.assertEqual(d.fullname, 'udo juergens')
+        self.assertEqual(sorted(d.keys())[0], 'firstname')
+        self.assertRaises(AttributeError, getattr, d, 'nonexisting')
+
+        # expired columns are not loaded
+        user = session.query(User).one()
+        session.expire(user, ['lastname'])
+        self.assertEqual(sorted(user.asDict()),
+                         ['firstname', 'fullname', 'id'])
+
+    def testColumnGetterCache(self):
+        from z3c.sqlalchemy.mapper import _column_getters
+
+        def asDict():
+            db = createSAWrapper(self.dsn)
+            User = db.getMapper('users')
+            User(id=1).asDict()
+            self.assertIn(User, _column_getters)
+            db.engine.dispose()
+            return weakref.ref(User)
+
+        # the cached getters do not keep the classes of discarded
+        # wrappers alive
+        ref = asDict()
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def testClone(self):
+        User = self.db.getMapper('users')
+        session = self.db.session
+        session.add(User(id=1, firstname='udo', lastname='juergens'))
+        session.flush()
+
+        clone = session.query(User).one().clone()
+        clone.id = 2
+        session.add(clone)
+        session.flush()
+        rows = session.query(User).order_by(User.id).all()
+        self.assertEqual([row.firstname for row in rows], ['udo', 'udo'])
+
+    def testStream(self):
+        User = self.db.getMapper('users')
+        session = self.db.session
+        for i in range(25):
+            session.add(User(id=i, firstname='first%d' % i, lastname='last'))
+        session.flush()
+        session.expunge_all()
+
+        ids = []
+        for user in self.db.stream('users', batch_size=10):
+            self.assertLessEqual(len(session.identity_map), 10)
+            ids.append(user.id)
+        self.assertEqual(sorted(ids), list(range(25)))
+        self.assertEqual(len(session.identity_map), 0)
+
+        rows = list(self.db.stream(User, User.id < 5, as_dict=True))
+        self.assertEqual(sorted(row['id'] for row in rows), list(range(5)))
+        self.assertEqual(rows[0].lastname, 'last')
+
+        rows = list(self.db.stream(User, {'firstname': 'first7'}))
+        self.assertEqual([row.id for row in rows], [7])
+
+    def testBulkInsert(self):
+        rows = ({'id': i, 'firstname': 'first%d' % i, 'lastname': 'last'}
+                for i in range(2500))
+        stats = self.db.bulkInsert('users', rows, chunk_size=1000)
+        self.assertEqual([chunk['rows'] for chunk in stats], [1000, 1000, 500])
+        self.assertEqual([chunk['chunk'] for chunk in stats], [0, 1, 2])
+        transaction.commit()
+
+        with self.db.engine.connect() as connection:
+            count = connection.exec_driver_sql(
+                'select count(*) from users').scalar()
+        self.assertEqual(count, 2500)
+
+    def testBulkUpsert(self):
+        self.db.bulkInsert('users', [{'id': 1, 'firstname': 'udo',
+                                      'lastname': 'juergens'}])
+        stats = self.db.bulkUpsert('users',
+                                   [{'id': 1, 'lastname': 'jürgens'},
+                                    {'id': 2, 'lastname': 'n/a'}])
+        self.assertEqual(len(stats), 1)
+        transaction.commit()
+
+        with self.db.engine.connect() as connection:
+            rows = connection.exec_driver_sql(
+                'select id, firstname, lastname from users '
+                'order by id').fetchall()
+        self.assertEqual([tuple(row) for row in rows],
+                         [(1, 'udo', 'jürgens'), (2, None, 'n/a')])
+
+    def testCopyRowReader(self):
+        rows = [(1, 'udo', None), (2, '', 'say "hi"'), (3, b'\x01', 1.5)]
+        reader = RowReader(iter(rows))
+        self.assertEqual(reader.read(4), b'1,"u')
+        self.assertEqual(reader.read(),
+                         b'do",\n'
+                         b'2,"","say ""hi"""\n'
+                         b'3,"\\x01",1.5\n')
+        self.assertEqual(reader.read(100), b'')
+
+    def testCopy(self):
+        from z3c.sqlalchemy.postgres import ZopePostgresWrapper
+
+        class Psycopg2Cursor:
+            # copy_expert() of psycopg2
+            def copy_expert(self, sql, file, size):
+                statements.append(sql)
+                if 'FROM STDIN' in sql:
+                    received.append(file.read())
+                else:
+                    file.write(b'1,udo\n')
+
+            def close(self):
+                pass
+
+        class Copy:
+            # cursor.copy() of psycopg 3
+            def __init__(self, sql):
+                statements.append(sql)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def write(self, data):
+                received.append(data)
+
+            def __iter__(self):
+                return iter([b'1,udo\n', b'2,heino\n'])
+
+        class Psycopg3Cursor:
+            copy = Copy
+
+            def close(self):
+                pass
+
+        db = ZopePostgresWrapper(self.dsn)
+        for cursor_class in (Psycopg2Cursor, Psycopg3Cursor):
+            statements, received = [], []
+            connection = mock.Mock()
+            connection.cursor.return_value = cursor_class()
+            with mock.patch.object(ZopePostgresWrapper, 'connection',
+                                   new_callable=mock.PropertyMock,
+                                   return_value=connection):
+                db.copyFrom('users', [(1, 'udo', None)],
+                            columns=['id', 'firstname', 'lastname'])
+                db.copyFrom('users', io.BytesIO(b'2\theino\n'),
+                            columns=['id', 'firstname'], format='TEXT')
+                out = io.BytesIO()
+                db.copyTo('users', out, columns=['id', 'firstname'])
+                self.assertRaises(ValueError, db.copyTo, 'users', out,
+                                  format='csv) TO PROGRAM (x')
+                self.assertRaises(ValueError, db.copyFrom, 'users',
+                                  io.BytesIO(), format='xml')
+            transaction.abort()
+
+            self.assertEqual(statements, [
+                'COPY users (id, firstname, lastname) FROM STDIN '
+                'WITH (FORMAT csv)',
+                'COPY users (id, firstname) FROM STDIN WITH (FORMAT text)',
+                'COPY users (id, firstname) TO STDOUT WITH (FORMAT csv)'])
+            self.assertEqual(b''.join(received), b'1,"udo",\n2\theino\n')
+            self.assertTrue(out.getvalue().startswith(b'1,udo\n'))
+
+    def _createReplica(self):
+        """ return the DSN of a replica containing a single user """
+
+        if self.tempfile is None:
+            self.skipTest('replica tests require SQLite')
+        filename = tempfile.mktemp()
+        self.addCleanup(os.remove, filename)
+        replica = createSAWrapper('sqlite:///%s' % filename)
+        metadata = MetaData()
+        users = Table('users', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('firstname', String(255)),
+                      Column('lastname', String(255)))
+        metadata.create_all(replica.engine)
+        with replica.engine.begin() as connection:
+            connection.execute(users.insert(),
+                               {'id': 99, 'firstname': 'replica'})
+        replica.engine.dispose()
+        return 'sqlite:///%s' % filename
+
+    def testReplicaRouting(self):
+        db = createSAWrapper(self.dsn, replicas=[self._createReplica()])
+        User = db.getMapper('users')
+        session = db.session
+
+        # reads are sent to the replica
+        self.assertEqual([user.id for user in session.query(User)], [99])
+
+        # anything after the first write goes to the primary
+        session.add(User(id=1, firstname='udo', lastname='juergens'))
+        session.flush()
+        self.assertEqual([user.id for user in session.query(User)], [1])
+
+        # a new transaction starts over
+        transaction.abort()
+        session = db.session
+        self.assertEqual([user.id for user in session.query(User)], [99])
+
+    def testReplicaFailover(self):
+        broken = 'sqlite:////nonexisting/directory/replica.db'
+        db = createSAWrapper(self.dsn,
+                             replicas=[broken, self._createReplica()],
+                             replica_strategy='least-connections')
+        health = db.checkReplicas()
+        self.assertEqual(sorted(health.values()), [False, True])
+
+        User = db.getMapper('users')
+        session = db.session
+        for i in range(3):
+            self.assertEqual([user.id for user in session.query(User)], [99])
+        transaction.abort()
+
+        # the request hitting a dead replica fails over to the next one
+        db = createSAWrapper(self.dsn,
+                             replicas=[broken, self._createReplica()])
+        User = db.getMapper('users')
+        for i in range(2):
+            self.assertEqual([user.id for user in db.session.query(User)],
+                             [99])
+            transaction.abort()
+        self.assertEqual(sorted(db.checkReplicas().values()), [False, True])
+
+        # all replicas down: reads go to the primary
+        db = createSAWrapper(self.dsn, replicas=[broken])
+        User = db.getMapper('users')
+        self.assertEqual(db.session.query(User).all(), [])
+        transaction.abort()
+
+    def testAsyncWrapper(self):
+        try:
+            import aiosqlite  # NOQA: F401
+        except ModuleNotFoundError:
+            self.skipTest('aiosqlite is not installed')
+        if self.tempfile is None:
+            self.skipTest('async tests require SQLite')
+
+        from z3c.sqlalchemy.asynchronous import AsyncZopeWrapper
+
+        db = createSAWrapper('sqlite+aiosqlite:///%s' % self.tempfile,
+                             async_=True)
+        self.assertIsInstance(db, AsyncZopeWrapper)
+        reflected = self._trackReflection()
+        sessions = []
+
+        async def request(i):
+            User = await db.getMapper('users')
+            session = db.session
+            sessions.append(session)
+            session.add(User(id=i, firstname='user%d' % i))
+            await session.commit()
+            await db.remove()
+
+        async def main():
+            await asyncio.gather(*[request(i) for i in range(10)])
+            rows = [row async for row in db.stream('users', batch_size=3,
+                                                   as_dict=True)]
+            await db.remove()
+            await db.engine.dispose()
+            return rows
+
+        rows = asyncio.run(main())
+        self.assertEqual(reflected, ['users'])
+        self.assertEqual(len(set(map(id, sessions))), 10)
+        self.assertEqual(sorted(row.id for row in rows), list(range(10)))
+
+        # the asynchronous variant has an interface of its own
+        verifyClass(IAsyncSQLAlchemyWrapper, AsyncZopeWrapper)
+        self.assertFalse(ISQLAlchemyWrapper.providedBy(db))
+        registerSAWrapper(db, 'test.async')
+        self.assertIs(getSAWrapper('test.async'), db)
+
+    def testAsyncBulkOperations(self):
+        try:
+            import aiosqlite  # NOQA: F401
+        except ModuleNotFoundError:
+            self.skipTest('aiosqlite is not installed')
+        if self.tempfile is None:
+            self.skipTest('async tests require SQLite')
+
+        db = createSAWrapper('sqlite+aiosqlite:///%s' % self.tempfile,
+                             async_=True)
+
+        async def main():
+            stats = await db.bulkInsert(
+                'users', [{'id': i, 'firstname': 'user%d' % i}
+                          for i in range(5)], chunk_size=2)
+            await db.bulkUpsert('users', [{'id': 4, 'firstname': 'changed'},
+                                          {'id': 5, 'firstname': 'new'}])
+            await db.session.commit()
+            await db.remove()
+            User = await db.getMapper('users')
+            rows = [(row.id, row.firstname) async for row in db.stream(User)]
+            await db.remove()
+            await db.engine.dispose()
+            return stats, rows
+
+        stats, rows = asyncio.run(main())
+        self.assertEqual([s['rows'] for s in stats], [2, 2, 1])
+        self.assertEqual(sorted(rows)[3:], [(3, 'user3'), (4, 'changed'),
+                                            (5, 'new')])
+
+    def testAsyncConcurrentMappers(self):
+        try:
+            import aiosqlite  # NOQA: F401
+        except ModuleNotFoundError:
+            self.skipTest('aiosqlite is not installed')
+        if self.tempfile is None:
+            self.skipTest('async tests require SQLite')
+
+        M = Model()
+        M.add('users', relations=('addresses',))
+        M.add('addresses')
+        db = createSAWrapper('sqlite+aiosqlite:///%s' % self.tempfile,
+                             model=M, async_=True)
+        reflected = self._trackReflection()
+
+        async def main():
+            # tasks mapping the same related table concurrently
+            mappers = await asyncio.gather(
+                *[db.getMapper(name)
+                  for name in ('users', 'addresses') * 5])
+            await db.engine.dispose()
+            return mappers
+
+        mappers = asyncio.run(main())
+        self.assertEqual(sorted(reflected), ['addresses', 'users'])
+        self.assertEqual(len(set(mappers)), 2)
+        db.configure()
+        self.assertIs(mappers[0].addresses.property.mapper.class_,
+                      mappers[1])
+
+    def testPoolStats(self):
+        db = createSAWrapper(self.dsn, name='test.poolstats')
+        connection = db.engine.connect()
+        stats = db.poolStats()
+        self.assertEqual(stats['checkedout'], 1)
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['wait']['count'], 1)
+        self.assertEqual(sum(count for bound, count
+                             in stats['wait']['histogram']), 1)
+        self.assertEqual(stats['age']['count'], 1)
+
+        connection.invalidate()
+        connection.close()
+        stats = db.poolStats()
+        self.assertEqual(stats['checkedout'], 0)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['age']['count'], 0)
+
+        all_stats = allSAWrapperPoolStats()
+        self.assertEqual(all_stats['wrappers']['test.poolstats'], stats)
+        self.assertGreaterEqual(all_stats['total']['invalidations'], 1)
+        self.assertGreaterEqual(all_stats['total']['wait']['count'], 1)
+
+        # engines derived through execution_options() and the pool created
+        # by dispose() are timed as well
+        engine = db.engine.execution_options(isolation_level='SERIALIZABLE')
+        engine.connect().close()
+        self.assertEqual(db.poolStats()['wait']['count'], 2)
+        db.engine.dispose()
+        db.engine.connect().close()
+        stats = db.poolStats()
+        self.assertEqual(stats['wait']['count'], 3)
+        self.assertEqual(stats['overflow'], 0)
+
+        # SingletonThreadPool (size is an int, no overflow)
+        stats = createSAWrapper('sqlite://').poolStats()
+        self.assertEqual((stats['size'], stats['overflow']), (0, 0))
+
+    def testQueryStats(self):
+        db = createSAWrapper(self.dsn, query_stats=True)
+        self.assertEqual(db.queryStats(), [])
+        User = db.getMapper('users')
+        session = db.session
+        session.add(User(id=1, firstname='udo', lastname='juergens'))
+        session.flush()
+        db.resetQueryStats()
+
+        for i in range(5):
+            session.query(User).filter(User.id == i).all()
+            session.execute(sqlalchemy.text(
+                'select * from users where id = %d' % i)).fetchall()
+        stats = db.queryStats()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual([entry['count'] for entry in stats], [5, 5])
+        literal = [entry for entry in stats
+                   if entry['statement'] == 'select * from users where id = ?']
+        self.assertEqual(len(literal), 1)
+        for entry in stats:
+            self.assertLessEqual(entry['p50'], entry['p95'])
+            self.assertLessEqual(entry['p95'], entry['max'])
+        self.assertEqual(len(db.queryStats(limit=1)), 1)
+
+    def testSlowQueryLog(self):
+        db = createSAWrapper(self.dsn, slow_query_threshold=0.0)
+        with self.assertLogs('z3c.sqlalchemy.slowquery', 'WARNING') as log:
+            db.session.execute(sqlalchemy.text(
+                'select * from users where id = :id'), {'id': 42})
+        self.assertIn('select * from users where id =', log.output[0])
+        self.assertIn('parameters: ', log.output[0])
+        self.assertIn('42', log.output[0])
+
+    def testTransactionProfile(self):
+        with self.db.engine.begin() as connection:
+            for i in range(12):
+                connection.execute(sqlalchemy.text(
+                    'insert into users (id, firstname) values (:id, :name)'),
+                    {'id': i, 'name': 'user %d' % i})
+                connection.execute(sqlalchemy.text(
+                    'insert into addresses (user_id, email) '
+                    'values (:id, :email)'),
+                    {'id': i, 'email': 'user%d@example.com' % i})
+
+        profiles = []
+        M = Model()
+        M.add('users', relations=('addresses',))
+        M.add('addresses')
+        db = createSAWrapper(self.dsn, model=M, profile_hook=profiles.append)
+        User = db.getMapper('users')
+        for user in db.session.query(User).all():
+            user.addresses
+        transaction.commit()
+
+        self.assertEqual(len(profiles), 1)
+        profile = profiles[0]
+        self.assertEqual(profile['statements'], 13)
+        self.assertGreater(profile['time'], 0.0)
+        self.assertEqual(list(profile['repeated'].values()), [12])
+        self.assertEqual(profile['nplusone'],
+                         [{'mapper': User.__name__,
+                           'relationship': 'addresses',
+                           'count': 12}])
+
+        # the next transaction starts with a new profile
+        db.session.get(User, 1)
+        transaction.abort()
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(profiles[1]['statements'], 1)
+        self.assertEqual(profiles[1]['nplusone'], [])
+
+    def testTransactionProfileLog(self):
+        M = Model()
+        M.add('users', relations=('addresses',))
+        M.add('addresses')
+        db = createSAWrapper(self.dsn, model=M, profile_transactions=True,
+                             nplusone_threshold=2)
+        User = db.getMapper('users')
+        session = db.session
+        for i in range(3):
+            session.add(User(id=i, firstname='user %d' % i))
+        session.flush()
+        session.expire_all()
+        with self.assertLogs('z3c.sqlalchemy.profile', 'WARNING') as log:
+            for user in session.query(User).all():
+                user.addresses
+            transaction.commit()
+        self.assertIn('likely N+1 selects: ', log.output[0])
+        self.assertIn('.addresses (3)', log.output[0])
+
+    def testTransactionProfileHookError(self):
+        def hook(profile):
+            raise RuntimeError('broken hook')
+
+        db = createSAWrapper(self.dsn, profile_hook=hook)
+        User = db.getMapper('users')
+        db.session.add(User(id=1, firstname='udo'))
+        with self.assertLogs('z3c.sqlalchemy.profile', 'ERROR') as log:
+            transaction.commit()
+        self.assertIn('broken hook', log.output[0])
+
+        # the transaction was committed and the next one works
+        self.assertEqual(db.session.get(User, 1).firstname, 'udo')
+        transaction.commit()
+
+    def testRelationLoaderStrategy(self):
+        with self.db.engine.begin() as connection:
+            for i in range(5):
+                connection.execute(sqlalchemy.text(
+                    'insert into users (id) values (:id)'), {'id': i})
+                connection.execute(sqlalchemy.text(
+                    'insert into addresses (user_id) values (:id)'),
+                    {'id': i})
+
+        M = Model()
+        M.add('users', relations=('addresses',), lazy='selectin')
+        M.add('addresses')
+        profiles = []
+        db = createSAWrapper(self.dsn, model=M, profile_hook=profiles.append)
+        User = db.getMapper('users')
+        self.assertEqual(
+            sqlalchemy.inspect(User).relationships['addresses'].lazy,
+            'selectin')
+        for user in db.session.query(User).all():
+            self.assertEqual(len(user.addresses), 1)
+        transaction.commit()
+        self.assertEqual(profiles[0]['statements'], 2)
+
+        M = Model()
+        M.add('users', relations=('addresses',), lazy={'addresses': 'raise'})
+        M.add('addresses')
+        db = createSAWrapper(self.dsn, model=M)
+        User = db.getMapper('users')
+        user = db.session.query(User).first()
+        self.assertRaises(exc.InvalidRequestError, getattr, user, 'addresses')
+
+    def testDefaultLoaderStrategy(self):
+        M = Model()
+        M.add('users', relations=('addresses',))
+        M.add('addresses')
+        db = createSAWrapper(self.dsn, model=M, default_lazy='joined')
+        User = db.getMapper('users')
+        self.assertEqual(
+            sqlalchemy.inspect(User).relationships['addresses'].lazy,
+            'joined')
+
+        self.assertRaises(ValueError, createSAWrapper, self.dsn,
+                          default_lazy='eager')
+        self.assertRaises(ValueError, M.add, 'skills', lazy='eager')
+        self.assertRaises(ValueError, M.add, 'skills',
+                          lazy={'addresses': 'eager'})
+        self.assertRaises(TypeError, M.add, 'skills', lazy=('selectin',))
+
+    def _createDocuments(self):
+        metadata = MetaData()
+        Table('documents', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('title', String(255)),
+              Column('abstract', String(4000)),
+              Column('body', Text),
+              Column('data', LargeBinary))
+        metadata.create_all(bind=self.db.engine)
+        with self.db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "insert into documents values (1, 'title', 'abstract', "
+                "'body', x'00')"))
+
+    def testDeferredColumns(self):
+        self._createDocuments()
+        M = Model()
+        M.add('documents', deferred={'content': ('body', 'data')})
+        db = createSAWrapper(self.dsn, model=M)
+        Document = db.getMapper('documents')
+        attrs = sqlalchemy.inspect(Document).attrs
+        self.assertFalse(attrs['title'].deferred)
+        self.assertTrue(attrs['body'].deferred)
+        self.assertEqual(attrs['data'].group, 'content')
+
+        doc = db.session.query(Document).one()
+        self.assertNotIn('body', doc.__dict__)
+        self.assertEqual(sorted(doc.asDict()), ['abstract', 'id', 'title'])
+        self.assertEqual(doc.body, 'body')
+        self.assertIn('data', doc.__dict__)
+
+        M = Model()
+        M.add('documents', deferred=('id',))
+        db = createSAWrapper(self.dsn, model=M)
+        self.assertRaises(ValueError, db.getMapper, 'documents')
+        self.assertRaises(TypeError, M.add, 'documents', deferred='body')
+
+    def testDeferredColumnsByType(self):
+        self._createDocuments()
+        db = createSAWrapper(self.dsn, defer_types=(Text, LargeBinary),
+                             defer_length=1000)
+        attrs = sqlalchemy.inspect(db.getMapper('documents')).attrs
+        self.assertEqual([attr.key for attr in attrs if attr.deferred],
+                         ['abstract', 'body', 'data'])
+        self.assertEqual(attrs['body'].group, 'deferred')
+        self.assertFalse(attrs['title'].deferred)
+        self.assertFalse(attrs['id'].deferred)
+
+    def testResultCache(self):
+        db = createSAWrapper(self.dsn, result_cache=True)
+        User = db.getMapper('users')
+        db.session.add(User(id=1, firstname='udo', lastname='juergens'))
+        transaction.commit()
+
+        users = db.cached('users', {'firstname': 'udo'})
+        self.assertEqual(db.cacheStats()['misses'], 1)
+        self.assertEqual(db.cached(User, User.firstname == 'udo',
+                                   as_dict=True),
+                         [{'id': 1, 'firstname': 'udo',
+                           'lastname': 'juergens'}])
+        self.assertEqual(db.cacheStats()['hits'], 1)
+        user = db.cached('users', {'firstname': 'udo'})[0]
+        self.assertIsNot(user, users[0])
+        self.assertTrue(sqlalchemy.inspect(user).detached)
+        self.assertEqual(user.lastname, 'juergens')
+        self.assertEqual(db.cacheStats()['hits'], 2)
+
+        # writes of the current transaction bypass the cache, the cache
+        # is invalidated when the transaction commits
+        user = db.session.get(User, 1)
+        user.lastname = 'lindenberg'
+        self.assertEqual(db.cached(User)[0].lastname, 'lindenberg')
+        transaction.abort()
+        self.assertEqual(db.cached(User)[0].lastname, 'juergens')
+
+        user = db.session.get(User, 1)
+        user.lastname = 'lindenberg'
+        transaction.commit()
+        self.assertEqual(db.cached(User)[0].lastname, 'lindenberg')
+
+        statement = sqlalchemy.select(User.__table__.c.lastname)
+        self.assertEqual(db.cached(statement), [('lindenberg',)])
+        db.bulkInsert('users', [{'id': 2, 'lastname': 'maffay'}])
+        self.assertEqual(len(db.cached(statement)), 2)
+        transaction.commit()
+        self.assertEqual(db.cached(statement, as_dict=True),
+                         [{'lastname': 'lindenberg'}, {'lastname': 'maffay'}])
+
+        # textual statements require the names of their tables
+        statement = sqlalchemy.text('SELECT lastname FROM users ORDER BY id')
+        self.assertRaises(ValueError, db.cached, statement)
+        self.assertEqual(db.cached(statement, tables=('users',)),
+                         [('lindenberg',), ('maffay',)])
+        self.assertEqual(len(db.cached(statement, tables=('users',))), 2)
+        db.session.get(User, 2).lastname = 'kraus'
+        transaction.commit()
+        self.assertEqual(db.cached(statement, tables=('users',))[1],
+                         ('kraus',))
+
+    def testResultCacheLimits(self):
+        from z3c.sqlalchemy.cache import ResultCache
+        cache = ResultCache(max_entries=2, max_bytes=100, ttl=60)
+        cache.put('a', {'users'}, 'A', 10, cache.generation({'users'}))
+        cache.put('b', {'skills'}, 'B', 10, cache.generation({'skills'}))
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('c', {'users'}, 'C', 10, cache.generation({'users'}))
+        self.assertIsNone(cache.get('b'))
+        cache.put('d', {'skills'}, 'D', 95, cache.generation({'skills'}))
+        self.assertEqual(cache.statistics()['entries'], 1)
+        self.assertEqual(cache.get('d'), 'D')
+
+        generation = cache.generation({'users'})
+        cache.invalidate(['users'])
+        cache.put('e', {'users'}, 'E', 10, generation)
+        self.assertIsNone(cache.get('e'))
+
+        cache.ttl = -1
+        cache.put('f', {'users'}, 'F', 10, cache.generation({'users'}))
+        self.assertIsNone(cache.get('f'))
+
+    def testReferenceData(self):
+        with self.db.engine.begin() as connection:
+            for i, name in enumerate(('python', 'zope', 'sql')):
+                connection.execute(sqlalchemy.text(
+                    'insert into skills values (:id, :name)'),
+                    {'id': i, 'name': name})
+
+        M = Model()
+        M.add('skills', reference=('name',))
+        M.add('users')
+        db = createSAWrapper(self.dsn, model=M)
+        skills = db.getReferenceData('skills')
+        self.assertEqual(len(skills), 3)
+        self.assertEqual(skills.get(1).name, 'zope')
+        self.assertIsNone(skills.get(42))
+        self.assertEqual([row.user_id for row in skills.lookup('name', 'sql')],
+                         [2])
+        self.assertEqual(skills.lookup('name', 'java'), ())
+        self.assertRaises(KeyError, skills.lookup, 'user_id', 1)
+        self.assertRaises(ValueError, db.getReferenceData, 'users')
+
+        # snapshots are shared by all threads
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(db.getReferenceData('skills')))
+        thread.start()
+        thread.join()
+        self.assertIs(result[0], skills)
+
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "insert into skills values (3, 'java')"))
+        self.assertIs(db.getReferenceData('skills'), skills)
+        db.reloadReferenceData()
+        self.assertEqual(len(db.getReferenceData('skills')), 4)
+        self.assertEqual(len(skills), 3)
+
+        db._reference_data.reload_interval = 0
+        snapshot = db.getReferenceData('skills')
+        self.assertIsNot(db.getReferenceData('skills'), snapshot)
+        self.assertRaises(TypeError, M.add, 'skills', reference='name')
+
+    def testWarmup(self):
+        M = Model()
+        M.add('users', relations=('addresses',))
+        M.add('addresses')
+        reflected = self._trackReflection()
+        db = createSAWrapper(self.dsn, model=M, warmup={'connections': 3})
+        self.assertEqual(sorted(reflected), ['addresses', 'users'])
+        self.assertTrue(sqlalchemy.inspect(db.getMapper('users')).configured)
+        stats = db.poolStats()
+        self.assertEqual(stats['connects'], 3)
+        self.assertEqual(stats['checkedout'], 0)
+
+        timings = db.warmup(mappers=False, connections=100)
+        self.assertEqual(sorted(timings), ['connections', 'total'])
+        self.assertEqual(db.poolStats()['connects'],
+                         db.engine.pool.size())
+
+        # SingletonThreadPool (one connection per thread)
+        db = createSAWrapper('sqlite://')
+        db.warmup(mappers=False, connections=2)
+        self.assertGreaterEqual(db.poolStats()['connects'], 1)
+        db.warmup(mappers=False, connections=0)
+
+    def testAsyncWarmup(self):
+        try:
+            import aiosqlite  # NOQA: F401
+        except ModuleNotFoundError:
+            self.skipTest('aiosqlite is not installed')
+        if self.tempfile is None:
+            self.skipTest('async tests require SQLite')
+
+        M = Model()
+        M.add('users')
+        dsn = 'sqlite+aiosqlite:///%s' % self.tempfile
+        self.assertRaises(ValueError, createSAWrapper, dsn, model=M,
+                          async_=True, warmup=True)
+        db = createSAWrapper(dsn, model=M, async_=True)
+
+        async def main():
+            timings = await db.warmup(connections=2)
+            await db.engine.dispose()
+            return timings
+
+        timings = asyncio.run(main())
+        self.assertEqual(sorted(timings),
+                         ['configure', 'connections', 'mappers', 'total'])
+        self.assertIn('users', db._mappers)
+        self.assertEqual(db.poolStats()['connects'], 2)
+
+    def testParallelReflection(self):
+        if self.tempfile is None:
+            self.skipTest('requires SQLite')
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def attach(dbapi_connection, connection_record):
+            for schema in ('east', 'west'):
+                dbapi_connection.execute(
+                    "ATTACH DATABASE '%s' AS %s" %
+                    (os.path.join(directory, schema), schema))
+
+        M = Model()
+        for schema in ('east', 'west'):
+            M.add('%s_orders' % schema, table_name='%s.orders' % schema)
+            M.add('%s_customers' % schema,
+                  table_name='%s.customers' % schema)
+        db = createSAWrapper(self.dsn, model=M, reflection_workers=4)
+        sqlalchemy.event.listen(db.engine, 'connect', attach)
+
+        for schema in ('east', 'west'):
+            metadata = MetaData(schema=schema)
+            Table('customers', metadata,
+                  Column('id', Integer, primary_key=True))
+            Table('orders', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('customer_id', Integer,
+                         ForeignKey('%s.customers.id' % schema)))
+            metadata.create_all(bind=db.engine)
+
+        threads = set()
+
+        def column_reflect(inspector, table, column_info):
+            threads.add(threading.get_ident())
+
+        sqlalchemy.event.listen(Table, 'column_reflect', column_reflect)
+        self.addCleanup(sqlalchemy.event.remove,
+                        Table, 'column_reflect', column_reflect)
+        reflected = self._trackReflection()
+        mappers = db.preload()
+
+        self.assertEqual(len(mappers), 4)
+        self.assertEqual(sorted(db.metadata.tables),
+                         ['east.customers', 'east.orders',
+                          'west.customers', 'west.orders'])
+        # one reflection per table, all of them by worker threads
+        self.assertEqual(sorted(reflected),
+                         ['customers', 'customers', 'orders', 'orders'])
+        self.assertNotIn(threading.get_ident(), threads)
+        orders = db.metadata.tables['west.orders']
+        self.assertIs(
+            list(orders.foreign_keys)[0].column.table,
+            db.metadata.tables['west.customers'])
+        EastOrder = db.getMapper('east_orders')
+        db.session.add(EastOrder(id=1, customer_id=None))
+        db.session.flush()
+        transaction.abort()
+
+    def testShardedWrapper(self):
+        if self.tempfile is None:
+            self.skipTest('requires SQLite')
+
+        from z3c.sqlalchemy.sharding import ShardedZopeWrapper
+
+        other = tempfile.mktemp()
+        self.addCleanup(os.remove, other)
+        shards = {'even': self.dsn, 'odd': 'sqlite:///%s' % other}
+        metadata = MetaData()
+        Table('users', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('firstname', String(255)),
+              Column('lastname', String(255)))
+        engine = sqlalchemy.create_engine(shards['odd'])
+        metadata.create_all(bind=engine)
+
+        def shard_chooser(mapper, instance, clause=None):
+            return instance.id % 2 and 'odd' or 'even'
+
+        db = ShardedZopeWrapper(shards, shard_chooser)
+        User = db.getMapper('users')
+        session = db.session
+        for i in range(4):
+            session.add(User(id=i, firstname='user %d' % i))
+        transaction.commit()
+
+        with engine.connect() as connection:
+            self.assertEqual(
+                [row.id for row in connection.exec_driver_sql(
+                    'select id from users order by id')], [1, 3])
+        self.assertEqual(sorted([user.id for user in
+                                 db.session.query(User).all()]),
+                         [0, 1, 2, 3])
+        transaction.abort()
+
+        users = db.fanout(sqlalchemy.select(User), key=lambda u: u.id)
+        self.assertEqual([user.id for user in users], [0, 1, 2, 3])
+        self.assertTrue(sqlalchemy.inspect(users[0]).detached)
+        rows = db.fanout(sqlalchemy.select(User.__table__.c.id),
+                         shards=['odd'], as_dict=True)
+        self.assertEqual(rows, [{'id': 1}, {'id': 3}])
+
+        # all shards take part in the same Zope transaction
+        session = db.session
+        session.add(User(id=4))
+        session.add(User(id=5))
+        session.flush()
+        transaction.abort()
+        self.assertEqual(len(db.fanout(sqlalchemy.select(User))), 4)
+        self.assertEqual(db.fanout(sqlalchemy.select(User), shards=[]), [])
+        self.assertEqual(sorted(db.shardPoolStats()), ['even', 'odd'])
+        self.assertGreaterEqual(db.poolStats()['connects'], 2)
+        engine.dispose()
+
+        # bulk operations write every row to its shard only
+        stats = db.bulkInsert('users', [{'id': 10}, {'id': 11}, {'id': 13}])
+        self.assertEqual(sorted([s['rows'] for s in stats]), [1, 2])
+        db.bulkUpsert('users', [{'id': 11, 'lastname': 'odd'},
+                                {'id': 12, 'lastname': 'even'}])
+        transaction.commit()
+        for shard_id, ids in (('even', [0, 2, 10, 12]),
+                              ('odd', [1, 3, 11, 13])):
+            rows = db.fanout(sqlalchemy.select(User.__table__),
+                             shards=[shard_id], key=lambda row: row.id)
+            self.assertEqual([row.id for row in rows], ids)
+            self.assertEqual([row.lastname for row in rows
+                              if row.id in (11, 12)], [shard_id])
+        self.assertRaises(NotImplementedError, db.getReferenceData, 'users')
+
+    def testLazyEngine(self):
+        from z3c.sqlalchemy import fork
+
+        # the driver is not imported until the wrapper is used
+        db = createSAWrapper('postgresql+nosuchdriver://host/db',
+                             lazy_engine=True)
+        self.assertIsNone(db._v_engine)
+        self.assertEqual(db.poolStats()['connects'], 0)
+        self.assertRaises(exc.NoSuchModuleError, getattr, db, 'session')
+
+        M = Model()
+        M.add('users')
+        reflection_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, reflection_cache)
+        db = createSAWrapper(self.dsn, model=M, lazy_engine=True,
+                             reflection_cache=reflection_cache)
+        self.assertIsNone(db._v_engine)
+        User = db.getMapper('users')
+        self.assertIsNotNone(db._v_engine)
+        db.reflection_cache.flush()
+        db.session.add(User(id=1))
+        transaction.commit()
+
+        db = createSAWrapper(self.dsn, model=M, lazy_engine=True,
+                             reflection_cache=reflection_cache)
+        reflected = self._trackReflection()
+        self.assertEqual(db.session.query(db.getMapper('users')).count(), 1)
+        self.assertEqual(reflected, [])
+        transaction.abort()
+
+        # other threads wait until the setup of the engine is complete
+        db = createSAWrapper(self.dsn, model=M, lazy_engine=True,
+                             reflection_cache=reflection_cache)
+        load = db.reflection_cache.load
+        sessions = []
+        threads = []
+
+        def slow_load(engine, metadata):
+            thread = threading.Thread(
+                target=lambda: sessions.append(db.session))
+            thread.start()
+            threads.append(thread)
+            thread.join(0.2)
+            self.assertEqual(sessions, [])
+            self.assertIsNone(db._v_sessionmaker)
+            self.assertIn(db, fork._wrappers)
+            return load(engine, metadata)
+
+        with mock.patch.object(db.reflection_cache, 'load',
+                               side_effect=slow_load):
+            db.session
+        threads[0].join()
+        self.assertEqual(len(sessions), 1)
+        transaction.abort()
+
+    def testIdleTimeout(self):
+        from z3c.sqlalchemy.idle import reaper
+
+        db = createSAWrapper(self.dsn, idle_timeout=60)
+        self.assertIn(db, reaper._wrappers)
+        self.assertFalse(db._disposeIfIdle(time.monotonic()))
+
+        connection = db.engine.connect()
+        pool = db.engine.pool
+        self.assertFalse(db._disposeIfIdle(time.monotonic() + 120))
+        connection.close()
+        self.assertEqual(pool.checkedin(), 1)
+        self.assertTrue(db._disposeIfIdle(time.monotonic() + 120))
+        self.assertEqual(pool.checkedin(), 0)
+        self.assertIsNot(db.engine.pool, pool)
+        # nothing to do until the pool is used again
+        self.assertFalse(db._disposeIfIdle(time.monotonic() + 120))
+
+        db.session.execute(sqlalchemy.text('select 1'))
+        transaction.commit()
+        db.idle_timeout = 0
+        self.assertGreaterEqual(reaper.reap(), 1)
+        self.assertEqual(db.engine.pool.checkedin(), 0)
+
+        thread = reaper._thread
+        reaper.unregister(db)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def testForkSafety(self):
+        db = createSAWrapper(self.dsn)
+        db.session.execute(sqlalchemy.text('select 1'))
+        transaction.commit()
+        pool = db.engine.pool
+        parent_connection = pool.connect()
+        parent_dbapi = parent_connection.dbapi_connection
+        parent_connection.close()
+        self.assertEqual(pool.checkedin(), 1)
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child: report back through the pipe, never return
+            status = 1
+            try:
+                os.close(read)
+                connection = db.engine.pool.connect()
+                fresh = (db.engine.pool is not pool and
+                         connection.dbapi_connection is not parent_dbapi)
+                db.session.execute(sqlalchemy.text('select 1'))
+                transaction.commit()
+                os.write(write, fresh and b'fresh' or b'shared')
+                status = 0
+            finally:
+                os._exit(status)
+
+        os.close(write)
+        with os.fdopen(read, 'rb') as fp:
+            report = fp.read()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(report, b'fresh')
+
+        # the parent's connection has not been closed by the child
+        connection = pool.connect()
+        self.assertIs(connection.dbapi_connection, parent_dbapi)
+        connection.cursor().execute('select 1')
+        connection.close()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def testForkIdleReaper(self):
+        from z3c.sqlalchemy.idle import reaper
+
+        db = createSAWrapper(self.dsn, idle_timeout=60)
+        db.session.execute(sqlalchemy.text('select 1'))
+        transaction.commit()
+        # fork while the lock of the reaper is held (by another thread)
+        with reaper._lock:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    if db in reaper._wrappers and reaper._thread.is_alive():
+                        status = 0
+                finally:
+                    os._exit(status)
+
+        # a deadlocked child must not block the test run forever
+        deadline = time.monotonic() + 10
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            if time.monotonic() > deadline:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                self.fail('child process deadlocked')
+            time.sleep(0.01)
+        self.assertEqual(status, 0)
+
+        thread = reaper._thread
+        reaper.unregister(db)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def testForkLocks(self):
+        cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cachedir)
+        db = createSAWrapper(self.dsn, query_stats=True, result_cache=True,
+                             circuit_breaker=True, reflection_cache=cachedir)
+        db.reflection_cache.save_delay = 60
+        db.getMapper('users')
+        self.assertIsNotNone(db.reflection_cache._timer)
+        locks = [db._engine_lock, db._pool_stats._lock,
+                 db._query_stats._lock, db._result_cache._lock,
+                 db._circuit._lock, db.reflection_cache._lock,
+                 db._reference_data._lock, db._mappers._lock,
+                 db._mappers._metadata_lock, db._mappers._nameLock('skills'),
+                 db._mappers._mapper_factory._lock]
+
+        # fork while another thread holds all locks of the wrapper
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            for lock in locks:
+                lock.acquire()
+            acquired.set()
+            release.wait()
+            for lock in locks:
+                lock.release()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    db.getMapper('skills')
+                    db.session.execute(sqlalchemy.text('select 1'))
+                    transaction.commit()
+                    db.poolStats()
+                    db.queryStats()
+                    db.circuitState()
+                    db.cacheStats()
+                    # a write scheduled by the parent is rescheduled
+                    db.reflection_cache.scheduleSave(db.engine)
+                    if db.reflection_cache._timer is not None:
+                        db.reflection_cache._timer.cancel()
+                        status = 0
+                finally:
+                    os._exit(status)
+        finally:
+            release.set()
+            thread.join()
+
+        # a deadlocked child must not block the test run forever
+        deadline = time.monotonic() + 10
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            if time.monotonic() > deadline:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                self.fail('child process deadlocked')
+            time.sleep(0.01)
+        self.assertEqual(status, 0)
+        db.reflection_cache.flush()
+
+    def testForeignPidCheckout(self):
+        from z3c.sqlalchemy.fork import PID_KEY
+
+        db = createSAWrapper(self.dsn)
+        connection = db.engine.connect()
+        dbapi = connection.connection.dbapi_connection
+        record = connection.connection._connection_record
+        self.assertEqual(record.info[PID_KEY], os.getpid())
+        connection.close()
+
+        # pretend the pooled connection has been created by another process
+        record.info[PID_KEY] = -1
+        with db.engine.connect() as connection:
+            self.assertIsNot(connection.connection.dbapi_connection, dbapi)
+            connection.execute(sqlalchemy.text('select 1'))
+
+        unprotected = createSAWrapper(self.dsn, fork_safe=False)
+        with unprotected.engine.connect() as connection:
+            self.assertNotIn(PID_KEY,
+                             connection.connection._connection_record.info)
+
+    def testCircuitBreaker(self):
+        from z3c.sqlalchemy.circuit import CircuitOpenError
+
+        directory = tempfile.mkdtemp()
+        try:
+            # sqlite fails to open a database in a missing directory
+            dsn = 'sqlite:///%s' % os.path.join(directory, 'missing', 'x.db')
+            db = createSAWrapper(dsn, circuit_breaker=dict(threshold=2,
+                                                           cooldown=60))
+            self.assertEqual(db.circuitState()['state'], 'closed')
+            for i in range(2):
+                self.assertRaises(exc.OperationalError, db.session.execute,
+                                  sqlalchemy.text('select 1'))
+                transaction.abort()
+            state = db.circuitState()
+            self.assertEqual(state['state'], 'open')
+            self.assertEqual(state['failures'], 2)
+            self.assertEqual(state['trips'], 1)
+            self.assertGreater(state['retry_in'], 0)
+
+            # fail fast without connecting, also for derived engines
+            attempts = []
+            event.listen(db.engine, 'do_connect',
+                         lambda *args: attempts.append(args))
+            self.assertRaises(CircuitOpenError, lambda: db.session)
+            self.assertRaises(CircuitOpenError, db.engine.connect)
+            engine = db.engine.execution_options(
+                isolation_level='SERIALIZABLE')
+            self.assertRaises(CircuitOpenError, engine.connect)
+            self.assertEqual(attempts, [])
+            self.assertEqual(db.circuitState()['rejected'], 3)
+
+            # a failing probe after the cooldown opens the circuit again
+            db._circuit.cooldown = 0
+            self.assertRaises(exc.OperationalError, db.engine.connect)
+            self.assertEqual(db.circuitState()['state'], 'open')
+
+            # a successful probe closes it
+            os.mkdir(os.path.join(directory, 'missing'))
+            db.session.execute(sqlalchemy.text('select 1'))
+            transaction.commit()
+            state = db.circuitState()
+            self.assertEqual(state['state'], 'closed')
+            self.assertEqual(state['failures'], 0)
+            db.engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertIsNone(createSAWrapper(self.dsn).circuitState())
+
+    def testCircuitBreakerPoolTimeout(self):
+        from z3c.sqlalchemy.circuit import CircuitOpenError
+
+        options = dict(poolclass=sqlalchemy.QueuePool, pool_size=1,
+                       max_overflow=0, pool_timeout=0.01)
+        db = createSAWrapper(self.dsn, engine_options=options,
+                             circuit_breaker=dict(threshold=2, cooldown=60))
+        connection = db.engine.connect()
+        # all connections are checked out, waiting for the pool times out
+        for i in range(2):
+            self.assertRaises(exc.TimeoutError, db.engine.connect)
+        self.assertEqual(db.circuitState()['state'], 'open')
+        self.assertRaises(CircuitOpenError, db.engine.connect)
+
+        # a connection checked out after the cooldown closes the circuit
+        connection.close()
+        db._circuit.cooldown = 0
+        db.engine.connect().close()
+        self.assertEqual(db.circuitState()['state'], 'closed')
+        self.assertEqual(db.circuitState()['failures'], 0)
+
+        # the pool created by dispose() is guarded as well
+        db._circuit.cooldown = 60
+        db.engine.dispose()
+        connection = db.engine.connect()
+        for i in range(2):
+            self.assertRaises(exc.TimeoutError, db.engine.connect)
+        self.assertRaises(CircuitOpenError, db.engine.connect)
+        connection.close()
+        db.engine.dispose()
+
+    def testCircuitBreakerHalfOpen(self):
+        from z3c.sqlalchemy.circuit import CircuitBreaker
+        from z3c.sqlalchemy.circuit import CircuitOpenError
+
+        breaker = CircuitBreaker(threshold=1, cooldown=60)
+        breaker._failure(exc.OperationalError('connect', {}, None))
+        self.assertEqual(breaker.state()['state'], 'open')
+        # only a single probe is let through
+        breaker._opened -= 60
+        breaker._acquire()
+        self.assertEqual(breaker.state()['state'], 'half-open')
+        self.assertRaises(CircuitOpenError, breaker._acquire)
+        self.assertRaises(CircuitOpenError, breaker.check)
+        # a probe that never reported back (e.g. killed by a BaseException)
+        # is replaced after the cooldown
+        breaker._probe_started -= 60
+        breaker.check()
+        breaker._acquire()
+        self.assertRaises(CircuitOpenError, breaker._acquire)
+        breaker._success()
+        self.assertEqual(breaker.state()['state'], 'closed')
+        self.assertRaises(ValueError, CircuitBreaker, threshold=0)